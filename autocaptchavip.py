@@ -1,77 +1,293 @@
 import cv2
 import requests
 import numpy as np
-from io import BytesIO
 import os
-import json
+import struct
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from buffer_arena import get_arena
+from calibration import SliderCalibration
+from feature_cache import get_feature_cache
+from gap_pack import list_gap_files, open_gap_pack, template_hash
+from multiscale import DEFAULT_SCALES, MultiScaleMatcher, to_gray
+
+# Cache dùng chung trong tiến trình: {đường dẫn: (mtime, dữ liệu)}
+_png_template_cache = {}
+_slider_calibration_cache = {}
+
+_ERODE_KERNEL = np.ones((3, 3), np.uint8)
+_gap_save_lock = threading.Lock()
+
+def _load_cached(cache, path, loader):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        cache.pop(path, None)
+        return None
+    cached = cache.get(path)
+    if cached is None or cached[0] != mtime:
+        value = loader(path)
+        if value is None:
+            return None
+        cached = (mtime, value)
+        cache[path] = cached
+    return cached[1]
+
+def load_slider_calibration(json_path):
+    """Bảng puzzle_left -> slider_left đã dựng chỉ mục tra cứu, chỉ đọc lại khi file thay đổi"""
+    return _load_cached(_slider_calibration_cache, json_path, SliderCalibration.from_file)
+
+# Giải mã ảnh nền thẳng sang xám + IMREAD_REDUCED_* (xem benchmarks/bench_decode.py);
+# tắt mặc định cho tới khi đo xong độ lệch trên ảnh nền captcha thật
+REDUCED_DECODE = os.environ.get("REDUCED_DECODE", "0") == "1"
+
+# Đổi khi thay cách tiền xử lý ảnh nền để không dùng lại edge map cũ trong feature cache
+EDGE_FEATURE_VERSION = "edge-v1"
+
+REDUCED_DECODE_FLAGS = {
+    (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+    (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+    (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+    (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def probe_image_size(data):
+    """
+    Đọc kích thước ảnh từ header mà không giải mã
+    Returns:
+        (width, height, "png" | "jpeg") hoặc None nếu không nhận ra định dạng
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        width, height = struct.unpack(">II", data[16:24])
+        return width, height, "png"
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height, "jpeg"
+        if marker == 0xFF:
+            i += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            i += 2
+        else:
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+def warm_up(gap_image_folder="gap_image", json_path="captcha.json", gap_pack_path=None):
+    """
+    Nạp trước kho template gap và bảng slider để request đầu tiên không phải chờ I/O
+    Returns:
+        Thống kê số template / số dòng bảng đã nạp
+    """
+    stats = {"packed_templates": 0, "png_templates": 0, "slider_entries": 0}
+    pack = None
+    if gap_pack_path and os.path.exists(gap_pack_path):
+        pack = open_gap_pack(gap_pack_path)
+        pack.touch()
+        stats["packed_templates"] = len(pack)
+    for filename in list_gap_files(gap_image_folder):
+        if pack is not None and filename in pack:
+            continue
+        if _load_cached(_png_template_cache, os.path.join(gap_image_folder, filename), cv2.imread) is not None:
+            stats["png_templates"] += 1
+    # Thiếu file bảng slider không làm hỏng warm-up: solver tự báo lỗi khi thực sự cần tra bảng
+    calibration = load_slider_calibration(json_path)
+    stats["slider_entries"] = len(calibration) if calibration is not None else 0
+    return stats
 
 class PuzzleCaptchaSolver:
-    def __init__(self, gap_image_url, bg_image_url, output_image_path, gap_image_folder="gap_image", json_path="captchar.json"):
+    # Kích thước làm việc của ảnh nền (width, height)
+    BG_SIZE = (296, 200)
+    MATCH_MODES = ("single", "multiscale")
+
+    def __init__(self, gap_image_url, bg_image_url, output_image_path, gap_image_folder="gap_image", json_path="captchar.json", gap_pack_path=None, save_new_gaps=True, use_feature_cache=True, match_mode="single", match_scales=DEFAULT_SCALES, reduced_decode=None):
         self.gap_image_url = gap_image_url
         self.bg_image_url = bg_image_url
         self.output_image_path = output_image_path
         self.gap_image_folder = gap_image_folder
         self.json_path = json_path
+        self.gap_pack_path = gap_pack_path
+        # False: không thêm gap mới vào kho (ví dụ khi chấm lại dữ liệu cũ hàng loạt)
+        self.save_new_gaps = save_new_gaps
+        # Dùng lại edge map của ảnh nền đã gặp (feature_cache.py); None khi chưa tra cache
+        self.use_feature_cache = use_feature_cache
+        # None: theo biến môi trường REDUCED_DECODE
+        self.reduced_decode = REDUCED_DECODE if reduced_decode is None else reduced_decode
+        self.feature_cache_hit = None
+        # "single": khớp ở đúng tỉ lệ của template; "multiscale": dò nhiều tỉ lệ (multiscale.py)
+        # cho captcha có tỉ lệ gap/nền khác với kho gap hiện có
+        if match_mode not in self.MATCH_MODES:
+            raise ValueError(f"match_mode không hợp lệ: {match_mode}")
+        self.match_mode = match_mode
+        self.match_scales = tuple(match_scales)
+        # Ảnh đã giải mã sẵn (dùng khi client gửi mảng thay vì URL)
+        self.gap_image = None
+        self.bg_image = None
+        # Bytes ảnh nền chưa giải mã (upload hoặc đã tải về); chỉ giải mã khi feature cache trượt
+        self.bg_bytes = None
+        # Thời gian từng bước của lần discern gần nhất (ms) và hash ảnh đầu vào khi profiling
+        self.stage_timings = {}
+        self.collect_input_hashes = False
+        self.input_hashes = {}
+        self.profile_id = None
         
         if not os.path.exists(self.gap_image_folder):
             os.makedirs(self.gap_image_folder)
         
-        result_folder = os.path.dirname(self.output_image_path)
+        result_folder = os.path.dirname(self.output_image_path) if self.output_image_path else None
         if result_folder and not os.path.exists(result_folder):
             os.makedirs(result_folder)
         
         if not os.path.exists(self.json_path):
             raise FileNotFoundError(f"File {self.json_path} không tồn tại. Vui lòng cung cấp file captchar.json.")
 
-    def download_image(self, url):
-        try:
-            response = requests.get(url, timeout=10)
-            if response.status_code != 200:
-                raise Exception(f"Tải ảnh thất bại từ {url}. Mã trạng thái: {response.status_code}")
-            img_array = np.frombuffer(BytesIO(response.content).read(), np.uint8)
-            image = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-            if image is None:
-                raise Exception(f"Không thể giải mã ảnh từ {url}")
-            return image
-        except Exception as e:
-            raise
+    @classmethod
+    def from_arrays(cls, gap_image, bg_image, output_image_path, **kwargs):
+        """
+        Tạo solver từ ảnh đã giải mã thay vì URL
+        Parameters:
+            gap_image: Ảnh gap (BGR)
+            bg_image: Ảnh nền (BGR hoặc xám, kích thước bất kỳ)
+        """
+        solver = cls(None, None, output_image_path, **kwargs)
+        solver.gap_image = gap_image
+        solver.bg_image = bg_image
+        return solver
 
-    def remove_whitespace(self, image, threshold=30):
+    @classmethod
+    def from_bytes(cls, gap_bytes, bg_bytes, output_image_path, **kwargs):
+        """
+        Tạo solver từ bytes ảnh upload (gap_bytes có thể là None). Ảnh gap được giải mã ngay;
+        ảnh nền giữ nguyên bytes để tra feature cache trước, chỉ giải mã khi cache trượt.
+        """
+        solver = cls.from_arrays(None, None, output_image_path, **kwargs)
+        if gap_bytes is not None:
+            solver.gap_image = solver.decode_image(gap_bytes, source="ảnh gap upload")
+        if not bg_bytes:
+            raise ValueError("Không có dữ liệu ảnh từ ảnh nền upload")
+        solver.bg_bytes = bg_bytes
+        return solver
+
+    def load_gap_image(self):
+        """Ảnh gap, hoặc None nếu không có (khi đó chỉ khớp với kho gap hiện có)"""
+        if self.gap_image is not None:
+            return self.gap_image
+        if self.gap_image_url is None:
+            return None
+        return self.download_image(self.gap_image_url)
+
+    def load_background_bytes(self):
+        """Bytes ảnh nền chưa giải mã (tải từ URL ở lần gọi đầu), None nếu solver được tạo từ mảng"""
+        if self.bg_bytes is None and self.bg_image is None:
+            self.bg_bytes = self.fetch_image(self.bg_image_url)
+        return self.bg_bytes
+
+    def load_background(self):
+        """Ảnh nền ở kích thước BG_SIZE (xám nếu bật reduced_decode)"""
+        if self.bg_image is None:
+            # Với reduced_decode: chỉ cần edge map nên giải mã thẳng sang ảnh xám, thu nhỏ ngay khi giải mã
+            return self.decode_image(self.load_background_bytes(), target_size=self.BG_SIZE,
+                                     grayscale=self.reduced_decode, reduced=self.reduced_decode,
+                                     source=self.bg_image_url or "ảnh nền upload")
+        if (self.bg_image.shape[1], self.bg_image.shape[0]) != self.BG_SIZE:
+            return cv2.resize(self.bg_image, self.BG_SIZE, interpolation=cv2.INTER_AREA)
+        return self.bg_image
+
+    def fetch_image(self, url):
+        response = requests.get(url, timeout=10)
+        if response.status_code != 200:
+            raise Exception(f"Tải ảnh thất bại từ {url}. Mã trạng thái: {response.status_code}")
+        return response.content
+
+    def download_image(self, url, target_size=None, grayscale=False, reduced=False):
+        return self.decode_image(self.fetch_image(url), target_size=target_size, grayscale=grayscale, reduced=reduced, source=url)
+
+    def decode_image(self, data, target_size=None, grayscale=False, reduced=False, source="dữ liệu ảnh"):
+        """
+        Giải mã ảnh từ bytes, có thể thu nhỏ ngay khi giải mã
+        Parameters:
+            data: Bytes của ảnh (PNG/JPEG/...)
+            target_size: (width, height) cần có sau khi giải mã, None để giữ nguyên
+            grayscale: Giải mã thẳng sang ảnh xám (khi chỉ cần edge map)
+            reduced: Dùng IMREAD_REDUCED_* khi ảnh JPEG lớn hơn target_size nhiều lần
+        Returns:
+            Ảnh BGR hoặc ảnh xám, đúng kích thước target_size nếu có
+        """
+        if not data:
+            raise ValueError(f"Không có dữ liệu ảnh từ {source}")
+        img_array = np.frombuffer(data, np.uint8)
+        flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+        if reduced and target_size is not None:
+            flag = self.reduced_decode_flag(data, target_size, grayscale)
+        image = cv2.imdecode(img_array, flag)
+        if image is None:
+            raise ValueError(f"Không thể giải mã ảnh từ {source}")
+        if target_size is not None and (image.shape[1], image.shape[0]) != tuple(target_size):
+            image = cv2.resize(image, tuple(target_size), interpolation=cv2.INTER_AREA)
+        return image
+
+    def reduced_decode_flag(self, data, target_size, grayscale=False):
+        """
+        Chọn cờ IMREAD_REDUCED_* lớn nhất mà ảnh sau khi giảm vẫn không nhỏ hơn target_size.
+        Chỉ áp dụng cho JPEG: libjpeg thu nhỏ ngay ở bước IDCT nên bỏ được phần lớn
+        công giải mã; với PNG OpenCV vẫn giải mã đủ rồi mới resize nên giữ cờ thường.
+        """
+        plain_flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+        size = probe_image_size(data)
+        if size is None or size[2] != "jpeg":
+            return plain_flag
+        width, height = size[:2]
+        target_width, target_height = target_size
+        for factor in (8, 4, 2):
+            if width // factor >= target_width and height // factor >= target_height:
+                return REDUCED_DECODE_FLAGS[(factor, grayscale)]
+        return plain_flag
+
+    def remove_whitespace(self, image, threshold=30, is_binary=False):
         """
         Xóa nền trắng hoặc gần trắng khỏi ảnh background
         Parameters:
             image: Ảnh đầu vào (BGR)
             threshold: Ngưỡng để xác định màu gần trắng
+            is_binary: Ảnh đã là ảnh xám/ảnh cạnh (các kênh bằng nhau), bỏ qua bước đổi sang HSV
         Returns:
             Ảnh đã được cắt bỏ nền
         """
-        # Chuyển sang không gian màu HSV
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        arena = get_arena()
+        height, width = image.shape[:2]
         
-        # Xác định phạm vi màu trắng/ gần trắng trong HSV
-        lower_white = np.array([0, 0, 255 - threshold])
-        upper_white = np.array([180, threshold, 255])
-        mask = cv2.inRange(hsv, lower_white, upper_white)
-        
-        # Đảo ngược mask để giữ vùng nội dung
-        mask = cv2.bitwise_not(mask)
+        if is_binary:
+            # Với ảnh xám S = 0 và V = giá trị pixel, nên "gần trắng" chỉ còn là V >= 255 - threshold
+            gray = image if image.ndim == 2 else cv2.extractChannel(image, 0, dst=arena.get("ws_gray", (height, width)))
+            _, mask = cv2.threshold(gray, 254 - threshold, 255, cv2.THRESH_BINARY_INV, dst=arena.get("ws_mask", (height, width)))
+        else:
+            # Chuyển sang không gian màu HSV
+            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=arena.get("ws_hsv", image.shape))
+            
+            # Xác định phạm vi màu trắng/ gần trắng trong HSV
+            mask = cv2.inRange(hsv, (0, 0, 255 - threshold), (180, threshold, 255), dst=arena.get("ws_mask", (height, width)))
+            
+            # Đảo ngược mask để giữ vùng nội dung
+            mask = cv2.bitwise_not(mask, dst=mask)
         
-        # Tìm contours của vùng nội dung
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Bounding box của toàn bộ pixel nội dung, trùng với hợp các bounding box của contours ngoài
+        x_min, y_min, w, h = cv2.boundingRect(mask)
         
-        if not contours:
+        if w == 0 or h == 0:
             return image  # Trả về ảnh gốc nếu không tìm thấy nội dung
         
-        # Tính bounding box bao quanh tất cả contours
-        x_min, y_min = image.shape[1], image.shape[0]
-        x_max, y_max = 0, 0
-        
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            x_min = min(x_min, x)
-            y_min = min(y_min, y)
-            x_max = max(x_max, x + w)
-            y_max = max(y_max, y + h)
+        x_max, y_max = x_min + w, y_min + h
         
         # Thêm padding
         padding = 5
@@ -85,11 +301,23 @@ class PuzzleCaptchaSolver:
         return cropped if cropped.size > 0 else image
 
     def apply_edge_detection(self, img):
-        grayscale_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(grayscale_img, 100, 200)
-        return cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB)
+        """Edge map 3 kênh của ảnh (mảng mới, caller giữ lâu được)"""
+        height, width = img.shape[:2]
+        return self._edge_map(img, np.empty((height, width, 3), np.uint8))
+
+    def _edge_map(self, img, dst):
+        # Ghi edge map vào dst; ảnh xám và Canny trung gian nằm trong arena (ảnh nền luôn cùng BG_SIZE)
+        arena = get_arena()
+        height, width = img.shape[:2]
+        if img.ndim == 2:
+            grayscale_img = img
+        else:
+            grayscale_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=arena.get("edge_gray", (height, width)))
+        edges = cv2.Canny(grayscale_img, 100, 200, edges=arena.get("edge_canny", (height, width)))
+        return cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB, dst=dst)
 
     def extract_thin_outline(self, image):
+        # Ảnh gap mỗi captcha một kích thước nên không dùng arena (buffer theo shape hầu như không được dùng lại)
         grayscale = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         _, binary = cv2.threshold(grayscale, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
         contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -97,23 +325,19 @@ class PuzzleCaptchaSolver:
         if not contours:
             raise Exception("Không tìm thấy đường viền nào trong ảnh gap.")
         
-        mask = np.zeros_like(grayscale)
+        mask = np.zeros(grayscale.shape, np.uint8)
         cv2.drawContours(mask, contours, -1, (255), thickness=cv2.FILLED)
         
-        kernel = np.ones((3, 3), np.uint8)
-        eroded_mask = cv2.erode(mask, kernel, iterations=2)
-        outline_mask = mask - eroded_mask
-        
-        result = np.zeros_like(image)
-        result[outline_mask == 255] = [255, 255, 255]
+        eroded_mask = cv2.erode(mask, _ERODE_KERNEL, iterations=2)
+        # Vùng co lại luôn nằm trong mask nên phép trừ bão hòa cho kết quả như mask - eroded_mask
+        outline_mask = cv2.subtract(mask, eroded_mask, dst=mask)
         
-        y_coords, x_coords = np.where(outline_mask == 255)
-        if len(x_coords) == 0 or len(y_coords) == 0:
+        x_min, y_min, w, h = cv2.boundingRect(outline_mask)
+        if w == 0 or h == 0:
             raise Exception("Không tìm thấy viền sau khi xử lý.")
         
-        x_min, x_max = x_coords.min(), x_coords.max()
-        y_min, y_max = y_coords.min(), y_coords.max()
-        return result[y_min:y_max + 1, x_min:x_max + 1]
+        # outline_mask chỉ gồm 0/255 nên chuyển sang 3 kênh cho đúng ảnh viền trắng trên nền đen
+        return cv2.cvtColor(outline_mask[y_min:y_min + h, x_min:x_min + w], cv2.COLOR_GRAY2BGR)
 
     def is_duplicate(self, new_image, existing_image_path):
         existing_image = cv2.imread(existing_image_path)
@@ -124,30 +348,125 @@ class PuzzleCaptchaSolver:
         difference = cv2.absdiff(new_image, existing_image)
         return np.sum(difference) == 0
 
+    def load_gap_pack(self):
+        """Packfile template (nếu được cấu hình và tồn tại), ngược lại None"""
+        if self.gap_pack_path and os.path.exists(self.gap_pack_path):
+            return open_gap_pack(self.gap_pack_path)
+        return None
+
+    def iter_gap_templates(self):
+        """
+        Duyệt toàn bộ template gap
+        Returns:
+            Generator các cặp (đường dẫn gap, ảnh). Template trong packfile được
+            đọc qua memmap; file PNG mới lưu sau khi đóng gói vẫn được đọc từ thư mục.
+        """
+        pack = self.load_gap_pack()
+        if pack is not None:
+            for name, gap_image in pack.items():
+                yield os.path.join(self.gap_image_folder, name), gap_image
+        for filename in list_gap_files(self.gap_image_folder):
+            if pack is not None and filename in pack:
+                continue
+            gap_path = os.path.join(self.gap_image_folder, filename)
+            gap_image = _load_cached(_png_template_cache, gap_path, cv2.imread)
+            if gap_image is not None:
+                yield gap_path, gap_image
+
     def save_processed_gap(self, processed_gap):
-        for filename in os.listdir(self.gap_image_folder):
-            if filename.startswith("image_gap_") and filename.endswith(".png"):
-                existing_image_path = os.path.join(self.gap_image_folder, filename)
-                if self.is_duplicate(processed_gap, existing_image_path):
-                    return existing_image_path
-        
-        i = 1
-        while True:
-            gap_image_path = os.path.join(self.gap_image_folder, f"image_gap_{i}.png")
-            if not os.path.exists(gap_image_path):
-                break
-            i += 1
+        # Khóa cả bước dò trùng lẫn bước ghi để hai thread cùng gặp một gap mới không lưu hai bản
+        with _gap_save_lock:
+            pack = self.load_gap_pack()
+            if pack is not None:
+                packed_name = pack.find_by_hash(template_hash(processed_gap))
+                if packed_name is not None:
+                    return os.path.join(self.gap_image_folder, packed_name)
+
+            for filename in os.listdir(self.gap_image_folder):
+                if filename.startswith("image_gap_") and filename.endswith(".png"):
+                    if pack is not None and filename in pack:
+                        continue
+                    existing_image_path = os.path.join(self.gap_image_folder, filename)
+                    if self.is_duplicate(processed_gap, existing_image_path):
+                        return existing_image_path
         
-        cv2.imwrite(gap_image_path, processed_gap)
-        return gap_image_path
+            ok, encoded = cv2.imencode(".png", processed_gap)
+            if not ok:
+                raise Exception("Không mã hóa được ảnh gap sang PNG.")
+            # Bỏ qua cả tên đã có trong packfile: thư mục PNG có thể đã được dọn sau khi export,
+            # và iter_gap_templates bỏ qua file PNG trùng tên với template trong pack
+            i = 1
+            while True:
+                gap_image_path = os.path.join(self.gap_image_folder, f"image_gap_{i}.png")
+                if pack is not None and f"image_gap_{i}.png" in pack:
+                    i += 1
+                    continue
+                # O_EXCL: discern chạy song song trong nhiều thread/tiến trình, hai gap mới
+                # không được ghi đè lên nhau khi cùng chọn một số thứ tự
+                try:
+                    fd = os.open(gap_image_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                except FileExistsError:
+                    i += 1
+                    continue
+                with os.fdopen(fd, "wb") as f:
+                    f.write(encoded.tobytes())
+                return gap_image_path
+
+    def position_offset(self, tpl_width):
+        return min(0.357, round(tpl_width / 20, 3))
+
+    def preprocess_background(self, bg_image):
+        """Edge map đã cắt nền của ảnh nền (không qua feature cache)"""
+        return self._trimmed_edges(bg_image).copy()
+
+    def background_cache_key(self, bg_bytes, bg_image=None):
+        # Khóa theo bytes chưa giải mã nên lần trúng bỏ qua cả giải mã, resize lẫn Canny; kích thước làm việc
+        # và cách giải mã nằm trong khóa vì edge map phụ thuộc vào chúng. Solver tạo từ mảng thì khóa theo nội dung ảnh.
+        digest = f"raw-{hashlib.sha1(bg_bytes).hexdigest()}" if bg_bytes is not None else template_hash(bg_image)
+        decode = "reduced" if self.reduced_decode else "full"
+        return f"{EDGE_FEATURE_VERSION}-{self.BG_SIZE[0]}x{self.BG_SIZE[1]}-{decode}-{digest}"
 
-    def find_position_of_slide(self, slide_pic, background_pic, draw_on_image, draw_rectangle=False):
+    def load_background_edges(self):
+        """
+        Edge map đã cắt nền của ảnh nền. Ảnh nền đã gặp (trùng từng byte) lấy thẳng từ
+        feature cache; kết quả khi đó là mảng chỉ đọc dùng chung giữa các lần giải.
+        """
+        cache = get_feature_cache() if self.use_feature_cache else None
+        if cache is not None and not cache.enabled:
+            cache = None
+        with self.timed_stage("load_background"):
+            bg_bytes = self.load_background_bytes()
+            bg_image = self.load_background() if bg_bytes is None else None
+        self.record_input_hash("background", bg_image if bg_bytes is None else np.frombuffer(bg_bytes, np.uint8))
+        if cache is not None:
+            key = self.background_cache_key(bg_bytes, bg_image)
+            edges = cache.get(key)
+            self.feature_cache_hit = edges is not None
+            if edges is not None:
+                return edges
+        if bg_image is None:
+            with self.timed_stage("decode_background"):
+                bg_image = self.load_background()
+        with self.timed_stage("edge_detection"):
+            if cache is None:
+                return self.preprocess_background(bg_image)
+            # put() tự chép ra bản sao chỉ đọc
+            return cache.put(key, self._trimmed_edges(bg_image))
+
+    def _trimmed_edges(self, bg_image):
+        # View vào buffer "edge_rgb" của arena, bị ghi đè ở lần gọi sau: caller phải chép ra
+        height, width = bg_image.shape[:2]
+        edges = self._edge_map(bg_image, get_arena().get("edge_rgb", (height, width, 3)))
+        return self.remove_whitespace(edges, is_binary=True)
+
+    def find_position_of_slide(self, slide_pic, background_pic, draw_on_image, draw_rectangle=False, result=None):
         tpl_height, tpl_width = slide_pic.shape[:2]
-        result = cv2.matchTemplate(background_pic, slide_pic, cv2.TM_CCOEFF_NORMED)
+        if result is None:
+            result = cv2.matchTemplate(background_pic, slide_pic, cv2.TM_CCOEFF_NORMED)
         _, max_val, _, max_loc = cv2.minMaxLoc(result)
         bottom_right = (max_loc[0] + tpl_width, max_loc[1] + tpl_height)
         
-        offset = min(0.357, round(tpl_width / 20, 3))
+        offset = self.position_offset(tpl_width)
         
         if draw_rectangle and self.output_image_path:
             top_left = (int(max_loc[0] + offset), int(max_loc[1] + offset))
@@ -158,83 +477,164 @@ class PuzzleCaptchaSolver:
         final_position = round(max_loc[0] + offset, 3)
         return final_position, max_val
 
+    def refine_position(self, result, tpl_width, tpl_height, method="parabola"):
+        """
+        Tinh chỉnh vị trí dưới mức pixel từ bản đồ tương quan của matchTemplate
+        Parameters:
+            result: Bản đồ TM_CCOEFF_NORMED
+            tpl_width, tpl_height: Kích thước template
+            method: "parabola" hoặc "gaussian" (fit log giá trị, tự lùi về parabola nếu có giá trị <= 0)
+        Returns:
+            dict gồm subpixel_position (cùng hệ quy chiếu với position), đỉnh thứ hai
+            ngoài vùng lân cận của đỉnh tốt nhất và margin giữa hai đỉnh
+        """
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        x, y = max_loc
+        
+        dx = 0.0
+        if 0 < x < result.shape[1] - 1:
+            left, center, right = (float(v) for v in result[y, x - 1:x + 2])
+            if method == "gaussian" and min(left, center, right) > 0:
+                left, center, right = np.log(left), np.log(center), np.log(right)
+            denom = left - 2 * center + right
+            if denom < 0:
+                dx = max(-0.5, min(0.5, 0.5 * (left - right) / denom))
+        
+        # Che vùng lân cận đỉnh tốt nhất rồi tìm đỉnh cạnh tranh
+        # Bản sao thường: kích thước bản đồ đổi theo từng template nên buffer arena theo shape hầu như không được dùng lại
+        masked = result.copy()
+        half_w, half_h = max(1, tpl_width // 2), max(1, tpl_height // 2)
+        masked[max(0, y - half_h):y + half_h + 1, max(0, x - half_w):x + half_w + 1] = -1.0
+        _, second_val, _, _ = cv2.minMaxLoc(masked)
+        if second_val <= -1.0:
+            # Vùng che phủ toàn bộ bản đồ: không có đỉnh cạnh tranh, so với tương quan 0
+            second_val = 0.0
+        
+        return {
+            "subpixel_position": round(x + dx + self.position_offset(tpl_width), 3),
+            "second_confidence": float(second_val),
+            "confidence_margin": round(float(max_val - second_val), 4)
+        }
+
     def evaluate_all_gaps(self, background_pic, draw_on_image):
+        if self.match_mode == "multiscale":
+            return self.evaluate_multiscale(background_pic, draw_on_image)
         best_position = None
         best_confidence = -float('inf')
         best_gap_path = None
+        best_gap_image = None
+        best_match_map = None
         
-        for filename in os.listdir(self.gap_image_folder):
-            if filename.startswith("image_gap_") and filename.endswith(".png"):
-                gap_path = os.path.join(self.gap_image_folder, filename)
-                gap_image = cv2.imread(gap_path)
-                if gap_image is not None:
-                    position, confidence = self.find_position_of_slide(gap_image, background_pic, draw_on_image, draw_rectangle=False)
-                    if confidence > best_confidence:
-                        best_confidence = confidence
-                        best_position = position
-                        best_gap_path = gap_path
+        for gap_path, gap_image in self.iter_gap_templates():
+            # Giữ bản đồ tương quan của template tốt nhất để tinh chỉnh/vẽ mà không phải khớp lại
+            match_map = cv2.matchTemplate(background_pic, gap_image, cv2.TM_CCOEFF_NORMED)
+            position, confidence = self.find_position_of_slide(gap_image, background_pic, draw_on_image, draw_rectangle=False, result=match_map)
+            if confidence > best_confidence:
+                best_confidence = confidence
+                best_position = position
+                best_gap_path = gap_path
+                best_gap_image = gap_image
+                best_match_map = match_map
         
+        refinement = {"subpixel_position": None, "second_confidence": None, "confidence_margin": None}
         if best_gap_path:
-            gap_image = cv2.imread(best_gap_path)
-            self.find_position_of_slide(gap_image, background_pic, draw_on_image, draw_rectangle=True)
+            match_map = best_match_map
+            refinement = self.refine_position(match_map, best_gap_image.shape[1], best_gap_image.shape[0])
+            self.find_position_of_slide(best_gap_image, background_pic, draw_on_image, draw_rectangle=True, result=match_map)
         
         return {
             "best_position": best_position,
             "best_confidence": best_confidence,
-            "best_gap_image": best_gap_path
+            "best_gap_image": best_gap_path,
+            "match_scale": 1.0 if best_gap_path else None,
+            **refinement
+        }
+
+    def evaluate_multiscale(self, background_pic, draw_on_image):
+        """Như evaluate_all_gaps nhưng dò tỉ lệ template theo kiểu thô -> tinh"""
+        matcher = MultiScaleMatcher(scales=self.match_scales)
+        best = matcher.match(background_pic, self.iter_gap_templates())
+        if best is None:
+            return {"best_position": None, "best_confidence": -float('inf'), "best_gap_image": None,
+                    "match_scale": None, "subpixel_position": None, "second_confidence": None, "confidence_margin": None}
+        
+        # Bản đồ tương quan đầy đủ cho biến thể thắng để tinh chỉnh sub-pixel và tính margin như chế độ thường
+        background_gray = to_gray(background_pic)
+        template = best["template"]
+        match_map = cv2.matchTemplate(background_gray, template, cv2.TM_CCOEFF_NORMED)
+        position, confidence = self.find_position_of_slide(template, background_gray, draw_on_image, draw_rectangle=True, result=match_map)
+        refinement = self.refine_position(match_map, template.shape[1], template.shape[0])
+        return {
+            "best_position": position,
+            "best_confidence": confidence,
+            "best_gap_image": best["name"],
+            "match_scale": best["scale"],
+            **refinement
         }
 
     def find_nearest_slider(self, position):
         try:
-            with open(self.json_path, 'r') as f:
-                data = json.load(f)
+            calibration = load_slider_calibration(self.json_path)
             
-            if not data:
+            if not calibration:
                 raise ValueError("File captchar.json rỗng.")
             
-            nearest_puzzle_left = None
-            nearest_slider_left = None
-            min_distance = float('inf')
-            
-            for entry in data:
-                puzzle_left = entry.get("puzzle_left")
-                slider_left = entry.get("slider_left")
-                if puzzle_left is None or slider_left is None:
-                    continue
-                if puzzle_left >= position:
-                    distance = puzzle_left - position
-                    if distance < min_distance:
-                        min_distance = distance
-                        nearest_puzzle_left = puzzle_left
-                        nearest_slider_left = slider_left
-            
-            if nearest_puzzle_left is None:
-                max_puzzle_left = max(entry["puzzle_left"] for entry in data if "puzzle_left" in entry)
-                for entry in data:
-                    if entry["puzzle_left"] == max_puzzle_left:
-                        nearest_puzzle_left = entry["puzzle_left"]
-                        nearest_slider_left = entry["slider_left"]
-                        break
-            
-            return nearest_puzzle_left, nearest_slider_left
+            return calibration.snap_up(position)
         
         except Exception as e:
             return None, None
 
-    def discern(self):
-        gap_image = self.download_image(self.gap_image_url)
-        processed_gap = self.extract_thin_outline(gap_image)
-        saved_gap_path = self.save_processed_gap(processed_gap)
+    def calibrated_slider(self, position):
+        """slider_left nội suy giữa hai dòng của bảng (thay vì làm tròn lên dòng kế tiếp)"""
+        try:
+            calibration = load_slider_calibration(self.json_path)
+            return round(calibration.interpolate(position), 2) if calibration else None
+        except Exception as e:
+            return None
+
+    @contextmanager
+    def timed_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_timings[stage] = round((time.perf_counter() - start) * 1000, 3)
+
+    def record_input_hash(self, name, image):
+        if self.collect_input_hashes:
+            self.input_hashes[name] = hashlib.sha1(np.ascontiguousarray(image).tobytes()).hexdigest()
+
+    def discern(self, profiler=None):
+        """
+        Giải captcha
+        Parameters:
+            profiler: SolveProfiler (solve_profiler.py) để ghi lại profile của lần giải này, None để bỏ qua
+        """
+        if profiler is not None:
+            return profiler.run(self)
+        self.stage_timings = {}
+        
+        with self.timed_stage("load_gap"):
+            gap_image = self.load_gap_image()
+        if gap_image is not None:
+            self.record_input_hash("gap", gap_image)
+            with self.timed_stage("extract_outline"):
+                processed_gap = self.extract_thin_outline(gap_image)
+            if self.save_new_gaps:
+                with self.timed_stage("save_gap"):
+                    saved_gap_path = self.save_processed_gap(processed_gap)
         
-        bg_image = self.download_image(self.bg_image_url)
-        bg_image_resized = cv2.resize(bg_image, (296, 200), interpolation=cv2.INTER_AREA)
-        edge_detected_bg = self.apply_edge_detection(bg_image_resized)
-        edge_detected_bg = self.remove_whitespace(edge_detected_bg)
+        edge_detected_bg = self.load_background_edges()
         
-        result = self.evaluate_all_gaps(edge_detected_bg, edge_detected_bg)
+        with self.timed_stage("match"):
+            # Edge map có thể nằm trong cache nên vẽ kết quả lên bản sao
+            draw_on_image = edge_detected_bg.copy() if self.output_image_path else edge_detected_bg
+            result = self.evaluate_all_gaps(edge_detected_bg, draw_on_image)
         
         if result["best_position"] is not None:
-            nearest_puzzle_left, nearest_slider_left = self.find_nearest_slider(result["best_position"])
+            with self.timed_stage("slider_lookup"):
+                nearest_puzzle_left, nearest_slider_left = self.find_nearest_slider(result["best_position"])
+                calibrated_slider_left = self.calibrated_slider(result["subpixel_position"])
             return {
                 "position": result["best_position"],
                 "best_confidence": result["best_confidence"],
@@ -242,7 +642,11 @@ class PuzzleCaptchaSolver:
                 "gap_url": self.gap_image_url,
                 "result_image": self.output_image_path,
                 "nearest_puzzle_left": nearest_puzzle_left,
-                "nearest_slider_left": nearest_slider_left
+                "nearest_slider_left": nearest_slider_left,
+                "calibrated_slider_left": calibrated_slider_left,
+                "subpixel_position": result["subpixel_position"],
+                "confidence_margin": result["confidence_margin"],
+                "match_scale": result["match_scale"]
             }
         else:
             return {
@@ -252,7 +656,11 @@ class PuzzleCaptchaSolver:
                 "gap_url": self.gap_image_url,
                 "result_image": self.output_image_path,
                 "nearest_puzzle_left": None,
-                "nearest_slider_left": None
+                "nearest_slider_left": None,
+                "calibrated_slider_left": None,
+                "subpixel_position": None,
+                "confidence_margin": None,
+                "match_scale": None
             }
 
 if __name__ == "__main__":
@@ -265,12 +673,13 @@ if __name__ == "__main__":
         bg_image_url=bg_url,
         output_image_path=output_path,
         gap_image_folder="gap_image",
-        json_path="captcha.json"
+        json_path="captcha.json",
+        gap_pack_path=os.environ.get("GAP_PACK_PATH", "gap_image.pack")
     )
     
     result = solver.discern()
     if result["position"] is not None:
-        print(f"Vị trí tốt nhất của slide: {result['position']}")
+        print(f"Vị trí tốt nhất của slide: {result['position']} (sub-pixel: {result['subpixel_position']}, margin: {result['confidence_margin']})")
         print(f"Cặp gần nhất trong captchar.json - puzzle_left: {result['nearest_puzzle_left']}, slider_left: {result['nearest_slider_left']}")
     else:
         print("Không tìm thấy vị trí hợp lệ.")
@@ -1,18 +1,19 @@
-from fastapi import FastAPI, Form, HTTPException
+from fastapi import FastAPI, File, Form, Header, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+from fastapi.responses import JSONResponse
 from datetime import datetime, timedelta
 import pytz
 import json
 import asyncio
-from collections import deque
+import hashlib
+import socket
 import uvicorn
-from autocaptcha import PuzzleCaptchaSolver  # Import the PuzzleCaptchaSolver class
 import os
-import imagehash
-from PIL import Image
-import requests
+import sys
+import threading
+from solve_jobs import SingleFlight
+from shared_state import create_state_backend
+from solve_profiler import SolveProfiler, profile_requested
 
 app = FastAPI(title="Ticket Tracking API")
 
@@ -29,11 +30,26 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SPREADSHEET_ID = "1ExRHONdCvGq--lZggVEQFGHhhkMYtCuZiOiOisbWTj0"
 SHEET_NAME = 'huy1'
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+GAP_PACK_PATH = os.environ.get("GAP_PACK_PATH", "gap_image.pack")
+# "eager": khởi tạo Sheets đồng bộ khi khởi động (mặc định)
+# "lazy": nhận request ngay, khởi tạo Sheets + warm-up solver ở background
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "eager")
+# Fit lại bảng slider từ datacaptcha/captcha_data.json mỗi CALIBRATION_INTERVAL giây (0 = tắt)
+CALIBRATION_INTERVAL = float(os.environ.get("CALIBRATION_INTERVAL", "0"))
+CALIBRATION_TABLE = os.environ.get("CALIBRATION_TABLE", "captcha.json")
 
-ticket_queue = deque()
 vietnam_tz = pytz.timezone('Asia/Ho_Chi_Minh')
 sheets_service = None
-ticket_cache = []
+# Client Sheets (httplib2) không an toàn luồng: mọi thao tác Sheets giữ khóa này,
+# vì vòng dọn/khởi tạo chạy trong thread còn endpoint chạy trên event loop
+sheets_lock = threading.RLock()
+# Hàng đợi hết hạn + cache dòng sheet dùng chung giữa các worker (xem shared_state)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEADER_TTL = 30
+ticket_state = create_state_backend()
+readiness = {"sheets": False, "solver": False, "errors": {}}
+solve_flight = SingleFlight()
+solve_profiler = SolveProfiler.from_env()
 
 DATA_CAPTCHA_DIR = "datacaptcha"
 if not os.path.exists(DATA_CAPTCHA_DIR):
@@ -43,6 +59,9 @@ def init_google_sheets():
     global sheets_service
     try:
         if sheets_service is None:
+            # Import muộn để worker khởi động nhanh
+            from google.oauth2.service_account import Credentials
+            from googleapiclient.discovery import build
             with open(CREDENTIALS_FILE, 'r') as file:
                 creds_info = json.load(file)
             creds = Credentials.from_service_account_info(creds_info, scopes=SCOPES)
@@ -95,12 +114,11 @@ def ensure_headers_and_format(service):
         raise HTTPException(status_code=500, detail=f"Lỗi cấu hình tiêu đề: {str(e)}")
 
 def sync_tickets_with_cache(service):
-    global ticket_cache
     try:
         result = service.spreadsheets().values().get(
             spreadsheetId=SPREADSHEET_ID, range=f"{SHEET_NAME}!A2:C"
         ).execute()
-        ticket_cache = result.get('values', [])
+        ticket_state.set_cache(result.get('values', []))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi đồng bộ cache: {str(e)}")
 
@@ -119,13 +137,12 @@ def parse_timestamp(timestamp_str):
             raise ValueError(f"Không thể parse thời gian: {timestamp_str}")
 
 def check_existing_tickets(service):
-    global ticket_queue, ticket_cache
     try:
         sync_tickets_with_cache(service)
         now = datetime.now(vietnam_tz)
         expired_rows = []
 
-        for i, row in enumerate(ticket_cache, start=2):
+        for i, row in enumerate(ticket_state.get_cache(), start=2):
             if len(row) < 3:
                 print(f"Dòng {i} thiếu dữ liệu, bỏ qua.")
                 continue
@@ -136,7 +153,7 @@ def check_existing_tickets(service):
                 if now >= expiry_time:
                     expired_rows.append(i)
                 else:
-                    ticket_queue.append((i, expiry_time))
+                    ticket_state.push_expiry(i, expiry_time.timestamp())
             except ValueError as e:
                 print(f"Lỗi parse thời gian tại dòng {i}: {timestamp_str} - {str(e)}")
                 continue
@@ -147,99 +164,161 @@ def check_existing_tickets(service):
                     spreadsheetId=SPREADSHEET_ID,
                     range=f"{SHEET_NAME}!A{row}:C{row}"
                 ).execute()
-                ticket_cache.pop(row - 2)
+                ticket_state.pop_cache(row - 2)
                 print(f"Đã xóa ticket hết hạn tại dòng {row} khi khởi động")
 
     except Exception as e:
         print(f"Lỗi khi kiểm tra ticket hiện có: {str(e)}")
+        raise
+
+def rebuild_expiry_queue(service):
+    # Hàng đợi có thể còn dòng cũ (leader trước chết giữa chừng) hoặc thiếu dòng: dựng lại từ sheet.
+    # Xóa trước rồi mới quét, để ticket thêm trong lúc quét (ghi sheet trước, đẩy hàng đợi sau) không bị mất
+    ticket_state.clear_queue()
+    check_existing_tickets(service)
+
+def clear_expired_tickets(rebuild_queue):
+    """Một vòng dọn ticket của leader (gọi qua asyncio.to_thread: mọi lệnh Sheets ở đây đều chặn)"""
+    service = init_google_sheets()
+    if rebuild_queue:
+        with sheets_lock:
+            rebuild_expiry_queue(service)
+    now = datetime.now(vietnam_tz)
+    expired_rows = ticket_state.pop_expired(now.timestamp())
+
+    for row in sorted(expired_rows, reverse=True):
+        # Giữ khóa từng dòng để endpoint trên event loop chỉ phải chờ một lệnh Sheets
+        with sheets_lock:
+            service.spreadsheets().values().clear(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{SHEET_NAME}!A{row}:C{row}"
+            ).execute()
+            ticket_state.pop_cache(row - 2)
+        print(f"Đã xóa ticket tại dòng {row}")
 
 async def cleanup_expired_tickets():
-    global ticket_queue, ticket_cache
+    queue_rebuilt = False
     while True:
         try:
-            service = init_google_sheets()
-            now = datetime.now(vietnam_tz)
-            expired_rows = []
-
-            while ticket_queue:
-                row, expiry = ticket_queue[0]
-                if now >= expiry:
-                    expired_rows.append(row)
-                    ticket_queue.popleft()
-                else:
-                    break
-
-            if expired_rows:
-                for row in sorted(expired_rows, reverse=True):
-                    service.spreadsheets().values().clear(
-                        spreadsheetId=SPREADSHEET_ID,
-                        range=f"{SHEET_NAME}!A{row}:C{row}"
-                    ).execute()
-                    if row - 2 < len(ticket_cache):
-                        ticket_cache.pop(row - 2)
-                    print(f"Đã xóa ticket tại dòng {row}")
+            # Chỉ worker giữ quyền leader mới dọn ticket hết hạn
+            if not await asyncio.to_thread(ticket_state.acquire_leader, "ticket-cleanup", WORKER_ID, LEADER_TTL):
+                queue_rebuilt = False
+                await asyncio.sleep(10)
+                continue
+            # Lần đầu giành được quyền leader (lúc khởi động hoặc khi leader cũ mất lease) thì dựng lại hàng đợi
+            await asyncio.to_thread(clear_expired_tickets, not queue_rebuilt)
+            queue_rebuilt = True
 
             await asyncio.sleep(10)
         except Exception as e:
             print(f"Lỗi trong cleanup: {str(e)}")
             await asyncio.sleep(10)
 
+async def calibrate_slider_table():
+    from calibration import regenerate_table
+    samples_path = os.path.join(DATA_CAPTCHA_DIR, "captcha_data.json")
+    base_path = os.path.splitext(CALIBRATION_TABLE)[0] + ".base.json"
+    while True:
+        try:
+            # Chỉ một worker ghi lại bảng; các worker khác tự đọc lại khi file đổi
+            if await asyncio.to_thread(ticket_state.acquire_leader, "slider-calibration", WORKER_ID, CALIBRATION_INTERVAL + LEADER_TTL):
+                used = await asyncio.to_thread(regenerate_table, samples_path, base_path, CALIBRATION_TABLE)
+                if used:
+                    print(f"Đã hiệu chỉnh {CALIBRATION_TABLE} từ {used} mẫu")
+        except Exception as e:
+            print(f"Lỗi khi hiệu chỉnh bảng slider: {str(e)}")
+        await asyncio.sleep(CALIBRATION_INTERVAL)
+
+def initialize_sheets_state():
+    service = init_google_sheets()
+    with sheets_lock:
+        ensure_headers_and_format(service)
+    # Quét hàng đợi hết hạn do cleanup_expired_tickets làm mỗi khi giành quyền leader; ở đây chỉ
+    # đồng bộ cache nếu chưa worker nào làm, để add_ticket tính đúng số dòng ngay từ đầu
+    if not ticket_state.cache_size():
+        with sheets_lock:
+            sync_tickets_with_cache(service)
+    readiness["sheets"] = True
+
+def warm_up_solver():
+    from autocaptchavip import warm_up
+    stats = warm_up(gap_image_folder="gap_image", json_path=CALIBRATION_TABLE, gap_pack_path=GAP_PACK_PATH)
+    readiness["solver"] = True
+    print(f"Warm-up solver xong: {stats}")
+
+def feature_cache_stats():
+    # Chưa có solve nào thì cache chưa tồn tại: không import ở đây để /status không kéo numpy vào event loop
+    if "feature_cache" not in sys.modules:
+        return None
+    from feature_cache import get_feature_cache
+    return get_feature_cache().stats()
+
+async def background_initialize():
+    for name, step in (("solver", warm_up_solver), ("sheets", initialize_sheets_state)):
+        try:
+            await asyncio.to_thread(step)
+        except Exception as e:
+            readiness["errors"][name] = str(getattr(e, "detail", e))
+            print(f"Lỗi khởi tạo nền ({name}): {readiness['errors'][name]}")
+    asyncio.create_task(cleanup_expired_tickets())
+
 @app.post("/api/add-ticket")
 async def add_ticket(ticket: str = Form(...)):
-    global ticket_queue, ticket_cache
     try:
-        service = init_google_sheets()
-        ensure_headers_and_format(service)
+        with sheets_lock:
+            service = init_google_sheets()
+            ensure_headers_and_format(service)
 
-        now = datetime.now(vietnam_tz)
-        expiry = now + timedelta(minutes=5)
-        timestamp = now.strftime(TIME_FORMAT)
+            now = datetime.now(vietnam_tz)
+            expiry = now + timedelta(minutes=5)
+            timestamp = now.strftime(TIME_FORMAT)
 
-        values = [[ticket, "Mới", timestamp]]
-        service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{SHEET_NAME}!A:C",
-            valueInputOption="USER_ENTERED",
-            insertDataOption="INSERT_ROWS",
-            body={"values": values}
-        ).execute()
+            values = [[ticket, "Mới", timestamp]]
+            service.spreadsheets().values().append(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{SHEET_NAME}!A:C",
+                valueInputOption="USER_ENTERED",
+                insertDataOption="INSERT_ROWS",
+                body={"values": values}
+            ).execute()
 
-        ticket_cache.append([ticket, "Mới", timestamp])
-        row_count = len(ticket_cache) + 1
-        ticket_queue.append((row_count, expiry))
-        print(f"Thêm ticket mới tại dòng {row_count}, expiry = {expiry}")
+            row_count = ticket_state.append_cache([ticket, "Mới", timestamp]) + 1
+            ticket_state.push_expiry(row_count, expiry.timestamp())
+            print(f"Thêm ticket mới tại dòng {row_count}, expiry = {expiry}")
 
-        return {"status": True, "message": "Ticket đã được thêm"}
+            return {"status": True, "message": "Ticket đã được thêm"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi thêm ticket: {str(e)}")
 
 @app.get("/api/delete-ticket")
 async def delete_ticket(ticket: str):
-    global ticket_queue, ticket_cache
     try:
-        service = init_google_sheets()
-        if not ticket_cache:
-            sync_tickets_with_cache(service)
-
-        row_to_delete = None
-        for i, row in enumerate(ticket_cache, start=2):
-            if len(row) >= 1 and row[0] == ticket:
-                row_to_delete = i
-                break
+        with sheets_lock:
+            service = init_google_sheets()
+            ticket_cache = ticket_state.get_cache()
+            if not ticket_cache:
+                sync_tickets_with_cache(service)
+                ticket_cache = ticket_state.get_cache()
+
+            row_to_delete = None
+            for i, row in enumerate(ticket_cache, start=2):
+                if len(row) >= 1 and row[0] == ticket:
+                    row_to_delete = i
+                    break
 
-        if row_to_delete is None:
-            return {"status": False, "message": f"Không tìm thấy ticket {ticket}"}
+            if row_to_delete is None:
+                return {"status": False, "message": f"Không tìm thấy ticket {ticket}"}
 
-        service.spreadsheets().values().clear(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{SHEET_NAME}!A{row_to_delete}:C{row_to_delete}"
-        ).execute()
+            service.spreadsheets().values().clear(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{SHEET_NAME}!A{row_to_delete}:C{row_to_delete}"
+            ).execute()
         
-        ticket_cache.pop(row_to_delete - 2)
-        ticket_queue = deque([(row, expiry) for row, expiry in ticket_queue if row != row_to_delete])
+            ticket_state.pop_cache(row_to_delete - 2)
+            ticket_state.remove_row(row_to_delete)
         
-        print(f"Đã xóa ticket {ticket} tại dòng {row_to_delete}")
-        return {"status": True, "message": f"Đã xóa ticket {ticket}"}
+            print(f"Đã xóa ticket {ticket} tại dòng {row_to_delete}")
+            return {"status": True, "message": f"Đã xóa ticket {ticket}"}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi khi xóa ticket: {str(e)}")
@@ -247,49 +326,73 @@ async def delete_ticket(ticket: str):
 @app.get("/api/latest-ticket")
 async def get_latest_ticket():
     try:
-        service = init_google_sheets()
-        if not ticket_cache:
-            sync_tickets_with_cache(service)
+        with sheets_lock:
+            service = init_google_sheets()
+            ticket_cache = ticket_state.get_cache()
+            if not ticket_cache:
+                sync_tickets_with_cache(service)
+                ticket_cache = ticket_state.get_cache()
         
-        if not ticket_cache:
-            return {"status": False, "ticket": None, "message": "Không có ticket nào"}
+            if not ticket_cache:
+                return {"status": False, "ticket": None, "message": "Không có ticket nào"}
         
-        latest_row = ticket_cache[-1]
-        if len(latest_row) < 3:
-            raise HTTPException(status_code=500, detail="Dữ liệu ticket không hợp lệ")
+            latest_row = ticket_cache[-1]
+            if len(latest_row) < 3:
+                raise HTTPException(status_code=500, detail="Dữ liệu ticket không hợp lệ")
             
-        now = datetime.now(vietnam_tz)
-        timestamp_str = latest_row[2].strip()
+            now = datetime.now(vietnam_tz)
+            timestamp_str = latest_row[2].strip()
         
-        try:
-            ticket_time = parse_timestamp(timestamp_str)
-            time_diff = now - ticket_time
+            try:
+                ticket_time = parse_timestamp(timestamp_str)
+                time_diff = now - ticket_time
             
-            if time_diff > timedelta(minutes=3):
-                return {"status": False, "ticket": None, "message": "Ticket mới nhất đã quá 5 phút"}
+                if time_diff > timedelta(minutes=3):
+                    return {"status": False, "ticket": None, "message": "Ticket mới nhất đã quá 5 phút"}
                 
-            ticket_data = {
-                "ticket": latest_row[0],
-                "status": latest_row[1],
-                "timestamp": ticket_time.strftime(TIME_FORMAT)
-            }
-            return {"status": True, "ticket": ticket_data}
+                ticket_data = {
+                    "ticket": latest_row[0],
+                    "status": latest_row[1],
+                    "timestamp": ticket_time.strftime(TIME_FORMAT)
+                }
+                return {"status": True, "ticket": ticket_data}
             
-        except ValueError as e:
-            raise HTTPException(status_code=500, detail=f"Lỗi parse thời gian: {str(e)}")
+            except ValueError as e:
+                raise HTTPException(status_code=500, detail=f"Lỗi parse thời gian: {str(e)}")
             
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi khi lấy ticket mới nhất: {str(e)}")
 
+def run_solver(build_solver, profile=False):
+    """Dựng solver và giải (chạy trong thread); kèm profile_id để mọi request dùng chung kết quả đều nhận được"""
+    solver = build_solver()
+    result = solver.discern(profiler=solve_profiler if profile else None)
+    return dict(result, profile_id=solver.profile_id)
+
+def solve_response(result):
+    response = {
+        "status": True,
+        "position": result["position"],
+        "subpixel_position": result["subpixel_position"],
+        "confidence_margin": result["confidence_margin"],
+        "calibrated_slider_left": result["calibrated_slider_left"],
+        "message": "Captcha solved successfully"
+    }
+    if result["profile_id"]:
+        response["profile_id"] = result["profile_id"]
+    return response
+
 @app.post("/api/solve-captcha")
-async def solve_captcha(shadow: str = Form(...), back: str = Form(...)):
+async def solve_captcha(shadow: str = Form(...), back: str = Form(...), x_profile_solve: str = Header(None)):
     """
     Solve the captcha by processing the shadow and background image URLs.
 
     :param shadow: URL of the shadow (gap) image.
     :param back: URL of the background image.
+    :param x_profile_solve: Header "X-Profile-Solve: 1" để ghi profile của lần giải này.
     :return: The x-coordinate of the slide position.
     """
+    from autocaptchavip import PuzzleCaptchaSolver
     try:
         # Define the output path for the result image
         output_path = os.path.join("result", "captcha_result.png")
@@ -299,18 +402,53 @@ async def solve_captcha(shadow: str = Form(...), back: str = Form(...)):
         solver = PuzzleCaptchaSolver(
             gap_image_url=shadow,
             bg_image_url=back,
-            output_image_path=output_path
+            output_image_path=output_path,
+            json_path=CALIBRATION_TABLE,
+            gap_pack_path=GAP_PACK_PATH
         )
 
-        # Solve the captcha
-        result = solver.discern()
+        # Solve the captcha (request trùng URL đang chạy đồng thời dùng chung kết quả)
+        profile = solve_profiler.should_profile(profile_requested(x_profile_solve))
+        result = await solve_flight.run((shadow, back, profile), run_solver, lambda: solver, profile)
 
         # Return only the slide position
-        return {
-            "status": True,
-            "position": result["position"],
-            "message": "Captcha solved successfully"
-        }
+        return solve_response(result)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error solving captcha: {str(e)}")
+
+@app.post("/api/solve-captcha/upload")
+async def solve_captcha_upload(shadow: UploadFile = File(...), back: UploadFile = File(...), x_profile_solve: str = Header(None)):
+    """
+    Giống /api/solve-captcha nhưng nhận thẳng bytes ảnh (multipart) thay vì URL,
+    tránh việc server phải tải lại ảnh mà client đã có.
+
+    :param shadow: Ảnh gap (shadow).
+    :param back: Ảnh nền.
+    :param x_profile_solve: Header "X-Profile-Solve: 1" để ghi profile của lần giải này.
+    :return: The x-coordinate of the slide position.
+    """
+    from autocaptchavip import PuzzleCaptchaSolver
+    try:
+        os.makedirs("result", exist_ok=True)
+        shadow_bytes = await shadow.read()
+        back_bytes = await back.read()
+
+        def build_solver():
+            return PuzzleCaptchaSolver.from_bytes(
+                shadow_bytes,
+                back_bytes,
+                os.path.join("result", "captcha_result.png"),
+                json_path=CALIBRATION_TABLE,
+                gap_pack_path=GAP_PACK_PATH
+            )
+
+        # Giải mã + giải trong thread; request trùng ảnh đang chạy đồng thời dùng chung kết quả
+        profile = solve_profiler.should_profile(profile_requested(x_profile_solve))
+        key = ("bytes", hashlib.sha1(shadow_bytes).hexdigest(), hashlib.sha1(back_bytes).hexdigest(), profile)
+        result = await solve_flight.run(key, run_solver, build_solver, profile)
+        return solve_response(result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Ảnh không hợp lệ: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error solving captcha: {str(e)}")
 
@@ -320,6 +458,9 @@ def hash_image_url(image_url):
     :param image_url: URL of the image.
     :return: Hash string of the image.
     """
+    import imagehash
+    import requests
+    from PIL import Image
     try:
         response = requests.get(image_url, stream=True)
         response.raise_for_status()
@@ -380,14 +521,36 @@ async def check_status():
         "status": "online",
         "spreadsheet_id": SPREADSHEET_ID,
         "spreadsheet_url": f"https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}",
-        "timestamp": datetime.now().strftime(TIME_FORMAT)
+        "timestamp": datetime.now().strftime(TIME_FORMAT),
+        "worker_id": WORKER_ID,
+        "queued_tickets": ticket_state.queue_size(),
+        "solve_coalescing": solve_flight.stats(),
+        "feature_cache": feature_cache_stats()
     }
 
+@app.get("/ready")
+async def check_ready():
+    ready = readiness["sheets"] and readiness["solver"]
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "startup_mode": STARTUP_MODE,
+            "sheets": readiness["sheets"],
+            "solver": readiness["solver"],
+            "errors": readiness["errors"]
+        }
+    )
+
 @app.on_event("startup")
 async def on_startup():
-    service = init_google_sheets()
-    ensure_headers_and_format(service)
-    check_existing_tickets(service)
+    if CALIBRATION_INTERVAL > 0:
+        asyncio.create_task(calibrate_slider_table())
+    if STARTUP_MODE == "lazy":
+        asyncio.create_task(background_initialize())
+        return
+    initialize_sheets_state()
+    warm_up_solver()
     asyncio.create_task(cleanup_expired_tickets())
 
 if __name__ == "__main__":
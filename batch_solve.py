@@ -0,0 +1,176 @@
+"""
+Giải hàng loạt captcha từ manifest (file cục bộ hoặc URL) trên nhiều tiến trình.
+
+    python batch_solve.py datacaptcha/captcha_data.json results.jsonl --workers 8
+
+Manifest là JSON Lines (mỗi dòng một object) hoặc một mảng JSON. Mỗi entry cần ảnh nền
+(bg / bg_image_url / back / imageUrl) và có thể có ảnh gap (gap / gap_image_url / shadow);
+thiếu gap thì chỉ khớp với kho gap hiện có. "id" nếu không có sẽ là số thứ tự trong manifest.
+
+Kết quả được ghi dần ra JSON Lines; chạy lại cùng lệnh sẽ bỏ qua các id đã có trong file
+kết quả (thêm --retry-errors để giải lại các entry bị lỗi).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+GAP_KEYS = ("gap", "gap_image_url", "shadow", "gap_image")
+BG_KEYS = ("bg", "bg_image_url", "back", "imageUrl", "bg_image")
+RESULT_KEYS = ("position", "subpixel_position", "best_confidence", "confidence_margin",
+               "best_gap_image", "nearest_puzzle_left", "nearest_slider_left")
+
+_options = {}
+
+
+def iter_manifest(path):
+    """Đọc manifest dạng stream với JSON Lines, hoặc nạp cả mảng JSON; trả về (id, entry)."""
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == "[":
+            for index, entry in enumerate(json.load(f)):
+                yield str(entry.get("id", index)), entry
+            return
+        for index, line in enumerate(f):
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                yield str(entry.get("id", index)), entry
+
+
+def _first(entry, keys):
+    for key in keys:
+        if entry.get(key):
+            return entry[key]
+    return None
+
+
+def _read_source(source, base_dir):
+    if source.startswith(("http://", "https://")):
+        import requests
+        response = requests.get(source, timeout=10)
+        if response.status_code != 200:
+            raise Exception(f"Tải ảnh thất bại từ {source}. Mã trạng thái: {response.status_code}")
+        return response.content
+    with open(os.path.join(base_dir, source), "rb") as f:
+        return f.read()
+
+
+def _init_worker(options):
+    _options.update(options)
+    from autocaptchavip import warm_up
+    # Packfile được memmap nên các worker dùng chung page cache
+    warm_up(options["gap_image_folder"], options["json_path"], options["gap_pack_path"])
+
+
+def _solve_entry(task):
+    from autocaptchavip import PuzzleCaptchaSolver
+    entry_id, entry = task
+    start = time.perf_counter()
+    record = {"id": entry_id}
+    try:
+        gap_source = _first(entry, GAP_KEYS)
+        bg_source = _first(entry, BG_KEYS)
+        if bg_source is None:
+            raise ValueError("Entry không có ảnh nền")
+        solver = PuzzleCaptchaSolver.from_bytes(
+            _read_source(gap_source, _options["base_dir"]) if gap_source else None,
+            _read_source(bg_source, _options["base_dir"]),
+            None,
+            gap_image_folder=_options["gap_image_folder"],
+            json_path=_options["json_path"],
+            gap_pack_path=_options["gap_pack_path"],
+            save_new_gaps=_options["save_gaps"]
+        )
+        result = solver.discern()
+        record["ok"] = result["position"] is not None
+        record.update({k: result[k] for k in RESULT_KEYS})
+        if not record["ok"]:
+            record["error"] = "Không tìm thấy vị trí hợp lệ"
+    except Exception as e:
+        record["ok"] = False
+        record["error"] = str(e)
+    record["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    record["input"] = entry
+    return record
+
+
+def load_done_ids(output_path, retry_errors=False):
+    """Id đã có kết quả; cắt bỏ dòng cuối dở dang nếu lần chạy trước bị ngắt giữa chừng."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    for line in data.decode("utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("ok") or not retry_errors:
+            done.add(str(record["id"]))
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest")
+    parser.add_argument("output", help="File kết quả JSON Lines (ghi nối tiếp)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunksize", type=int, default=4)
+    parser.add_argument("--gap-image-folder", default="gap_image")
+    parser.add_argument("--gap-pack", default=os.environ.get("GAP_PACK_PATH", "gap_image.pack"))
+    parser.add_argument("--json-path", default="captcha.json")
+    parser.add_argument("--base-dir", default=None, help="Thư mục gốc cho đường dẫn ảnh tương đối (mặc định: thư mục của manifest)")
+    parser.add_argument("--save-gaps", action="store_true", help="Thêm gap mới gặp vào kho (mặc định không đụng vào kho)")
+    parser.add_argument("--retry-errors", action="store_true")
+    parser.add_argument("--progress-every", type=float, default=5, help="Giây giữa hai lần in tiến độ")
+    args = parser.parse_args(argv)
+
+    options = {
+        "gap_image_folder": args.gap_image_folder,
+        "gap_pack_path": args.gap_pack,
+        "json_path": args.json_path,
+        "base_dir": args.base_dir or os.path.dirname(os.path.abspath(args.manifest)),
+        "save_gaps": args.save_gaps,
+    }
+    done = load_done_ids(args.output, args.retry_errors)
+    if done:
+        print(f"Bỏ qua {len(done)} entry đã có kết quả trong {args.output}", file=sys.stderr)
+    tasks = ((entry_id, entry) for entry_id, entry in iter_manifest(args.manifest) if entry_id not in done)
+
+    processed = succeeded = 0
+    start = last_report = time.perf_counter()
+    with open(args.output, "a", encoding="utf-8") as out, \
+            multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(options,)) as pool:
+        for record in pool.imap_unordered(_solve_entry, tasks, chunksize=args.chunksize):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            processed += 1
+            succeeded += bool(record["ok"])
+            now = time.perf_counter()
+            if now - last_report >= args.progress_every:
+                last_report = now
+                print(f"{processed} captcha, {processed / (now - start):.1f}/s, lỗi {processed - succeeded}", file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "processed": processed,
+        "succeeded": succeeded,
+        "failed": processed - succeeded,
+        "skipped": len(done),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(processed / elapsed, 2) if elapsed else None,
+    }, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
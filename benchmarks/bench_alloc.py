@@ -0,0 +1,79 @@
+"""
+Đo số lần cấp phát buffer và bộ nhớ đỉnh cho mỗi lần giải trên ảnh cục bộ.
+
+    python benchmarks/bench_alloc.py shadow.png back.png --repeat 100
+
+- arena_allocations: số buffer arena phải cấp phát mới (lần đầu > 0, ổn định = 0)
+- numpy_blocks: số khối bộ nhớ numpy/OpenCV còn sống sau lần giải (tracemalloc)
+- peak_kb: bộ nhớ đỉnh được tracemalloc ghi nhận trong lần giải
+"""
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autocaptchavip import PuzzleCaptchaSolver
+from buffer_arena import get_arena
+
+
+def solve_once(solver, gap_bytes, bg_bytes):
+    gap_image = solver.decode_image(gap_bytes)
+    processed_gap = solver.extract_thin_outline(gap_image)
+    bg = solver.decode_image(bg_bytes, target_size=solver.BG_SIZE, grayscale=True)
+    trimmed = solver.preprocess_background(bg)
+    return processed_gap, solver.evaluate_all_gaps(trimmed, trimmed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("gap")
+    parser.add_argument("background")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--gap-folder", default="gap_image")
+    parser.add_argument("--gap-pack", default=None)
+    parser.add_argument("--json-path", default="captcha.json")
+    args = parser.parse_args()
+
+    with open(args.gap, "rb") as f:
+        gap_bytes = f.read()
+    with open(args.background, "rb") as f:
+        bg_bytes = f.read()
+
+    solver = PuzzleCaptchaSolver(None, None, None, gap_image_folder=args.gap_folder,
+                                 json_path=args.json_path, gap_pack_path=args.gap_pack)
+    arena = get_arena()
+    samples = []
+    tracemalloc.start()
+    for i in range(args.repeat):
+        allocations_before = arena.allocations
+        tracemalloc.reset_peak()
+        snapshot_before = tracemalloc.take_snapshot()
+        solve_once(solver, gap_bytes, bg_bytes)
+        snapshot_after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        new_blocks = sum(max(stat.count_diff, 0) for stat in snapshot_after.compare_to(snapshot_before, "filename"))
+        samples.append({
+            "iteration": i,
+            "arena_allocations": arena.allocations - allocations_before,
+            "numpy_blocks": new_blocks,
+            "peak_kb": round(peak / 1024, 1),
+        })
+    tracemalloc.stop()
+
+    steady = samples[1:] or samples
+    print(json.dumps({
+        "first_solve": samples[0],
+        "steady_state": {
+            "arena_allocations_per_solve": sum(s["arena_allocations"] for s in steady) / len(steady),
+            "numpy_blocks_per_solve": sum(s["numpy_blocks"] for s in steady) / len(steady),
+            "peak_kb_max": max(s["peak_kb"] for s in steady),
+        },
+        "arena": arena.stats(),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+So sánh đường giải mã cũ (giải mã màu đủ độ phân giải -> resize -> xám) với
+đường giải mã xám + IMREAD_REDUCED_* (decode_image(..., reduced=True), bật trong
+solver bằng REDUCED_DECODE=1). Kết quả đã đo nằm trong benchmarks/results/bench_decode.md.
+
+    python benchmarks/bench_decode.py back1.jpg back2.png --repeat 50
+
+In ra JSON: thời gian trung bình mỗi đường và sai khác edge map (tỉ lệ pixel
+Canny khác nhau, độ lệch vị trí khớp tốt nhất nếu có --gap-folder).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+
+from autocaptchavip import PuzzleCaptchaSolver, probe_image_size
+
+
+def legacy_edges(solver, data):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    resized = cv2.resize(image, solver.BG_SIZE, interpolation=cv2.INTER_AREA)
+    return solver.apply_edge_detection(resized)
+
+
+def reduced_edges(solver, data):
+    gray = solver.decode_image(data, target_size=solver.BG_SIZE, grayscale=True, reduced=True)
+    return solver.apply_edge_detection(gray)
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+", help="Ảnh nền (PNG/JPEG)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--gap-folder", default=None, help="Thư mục gap để so sánh vị trí khớp")
+    parser.add_argument("--json-path", default="captcha.json")
+    args = parser.parse_args()
+
+    solver = PuzzleCaptchaSolver(None, None, None, gap_image_folder=args.gap_folder or "gap_image", json_path=args.json_path)
+    report = []
+    for path in args.images:
+        with open(path, "rb") as f:
+            data = f.read()
+        legacy_ms, legacy = time_it(lambda: legacy_edges(solver, data), args.repeat)
+        reduced_ms, reduced = time_it(lambda: reduced_edges(solver, data), args.repeat)
+        entry = {
+            "image": path,
+            "source_size": probe_image_size(data),
+            "decode_flag": solver.reduced_decode_flag(data, solver.BG_SIZE, grayscale=True),
+            "legacy_ms": round(legacy_ms, 3),
+            "reduced_ms": round(reduced_ms, 3),
+            "speedup": round(legacy_ms / reduced_ms, 2) if reduced_ms else None,
+            "edge_pixel_mismatch": round(float(np.mean(legacy[:, :, 0] != reduced[:, :, 0])), 5),
+        }
+        if args.gap_folder:
+            legacy_match = solver.evaluate_all_gaps(solver.remove_whitespace(legacy), legacy.copy())
+            reduced_match = solver.evaluate_all_gaps(solver.remove_whitespace(reduced), reduced.copy())
+            entry["legacy_position"] = legacy_match["best_position"]
+            entry["reduced_position"] = reduced_match["best_position"]
+            if legacy_match["best_position"] is not None and reduced_match["best_position"] is not None:
+                entry["position_delta"] = round(abs(legacy_match["best_position"] - reduced_match["best_position"]), 3)
+        report.append(entry)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Đo chi phí các đường đi của feature cache ảnh nền (feature_cache.py) so với tiền xử lý đầy đủ.
+
+    python benchmarks/bench_feature_cache.py back1.jpg back2.jpg --repeat 200
+
+Với mỗi ảnh nền in ra thời gian trung bình (ms):
+- key_ms: tính khóa cache từ bytes chưa giải mã
+- full_ms: giải mã + resize + Canny + cắt nền (cache trượt)
+- memory_hit_ms: lấy từ tầng bộ nhớ
+- disk_hit_ms: lấy từ tầng đĩa (memmap) khi tầng bộ nhớ trống, như worker khác/vừa khởi động lại
+- miss_ms / miss_disk_ms: chi phí tra cache khi trượt, không có / có tầng đĩa
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autocaptchavip import PuzzleCaptchaSolver
+from feature_cache import FeatureCache
+
+
+def mean_ms(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return round((time.perf_counter() - start) * 1000 / repeat, 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--json-path", default="captcha.json")
+    args = parser.parse_args()
+
+    disk_dir = tempfile.mkdtemp(prefix="feature-cache-bench-")
+    try:
+        memory = FeatureCache(max_entries=256)
+        memory_only_miss = FeatureCache(max_entries=256)
+        # max_entries=0: mọi lần get đều đi xuống tầng đĩa
+        disk = FeatureCache(max_entries=0, disk_dir=disk_dir)
+        results = []
+        for path in args.images:
+            with open(path, "rb") as f:
+                data = f.read()
+            solver = PuzzleCaptchaSolver.from_bytes(None, data, None, json_path=args.json_path, use_feature_cache=False)
+            key = solver.background_cache_key(data)
+            edges = solver.preprocess_background(solver.load_background())
+            memory.put(key, edges)
+            disk.put(key, edges)
+            results.append({
+                "image": path,
+                "bytes": len(data),
+                "key_ms": mean_ms(lambda: solver.background_cache_key(data), args.repeat),
+                "full_ms": mean_ms(lambda: solver.preprocess_background(solver.load_background()), args.repeat),
+                "memory_hit_ms": mean_ms(lambda: memory.get(key), args.repeat),
+                "disk_hit_ms": mean_ms(lambda: disk.get(key), args.repeat),
+                "miss_ms": mean_ms(lambda: memory_only_miss.get(key + "-miss"), args.repeat),
+                "miss_disk_ms": mean_ms(lambda: disk.get(key + "-miss"), args.repeat),
+            })
+        print(json.dumps(results, indent=2))
+    finally:
+        shutil.rmtree(disk_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+So sánh khớp nhiều tỉ lệ thô -> tinh (multiscale.MultiScaleMatcher) với vòng lặp vét cạn
+mọi tỉ lệ (multiscale.naive_match) trên kho gap hiện có.
+
+    python benchmarks/bench_multiscale.py --background back.png --trials 20
+
+Mỗi lần thử lấy ngẫu nhiên một template trong kho, đổi tỉ lệ theo một giá trị trong
+--test-scales rồi chèn vào edge map ảnh nền (ảnh nhiễu nếu không có --background) tại
+vị trí ngẫu nhiên. Báo cáo thời gian trung bình, tỉ lệ tìm đúng vị trí (lệch <= 2 px)
+và tỉ lệ hai cách cho cùng kết quả.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autocaptchavip import PuzzleCaptchaSolver
+from multiscale import DEFAULT_SCALES, MultiScaleMatcher, naive_match, to_gray, transform_template
+
+
+def base_edges(solver, background_path, rng):
+    if background_path:
+        with open(background_path, "rb") as f:
+            bg = solver.decode_image(f.read(), target_size=solver.BG_SIZE, grayscale=True)
+    else:
+        noise = rng.integers(0, 256, (solver.BG_SIZE[1], solver.BG_SIZE[0]), dtype=np.uint8)
+        bg = cv2.GaussianBlur(noise, (9, 9), 0)
+    return to_gray(solver.apply_edge_detection(bg))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--background", default=None)
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument("--test-scales", default="0.6,0.8,1.0,1.3,1.75")
+    parser.add_argument("--gap-folder", default="gap_image")
+    parser.add_argument("--gap-pack", default=None)
+    parser.add_argument("--json-path", default="captcha.json")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    solver = PuzzleCaptchaSolver(None, None, None, gap_image_folder=args.gap_folder,
+                                 json_path=args.json_path, gap_pack_path=args.gap_pack)
+    templates = [(name, np.asarray(image)) for name, image in solver.iter_gap_templates()]
+    if not templates:
+        sys.exit("Kho gap rỗng")
+    edges = base_edges(solver, args.background, rng)
+    test_scales = [float(s) for s in args.test_scales.split(",")]
+
+    matcher = MultiScaleMatcher(scales=DEFAULT_SCALES)
+    # Dựng sẵn kim tự tháp như khi server đã chạy một lúc
+    matcher.match(edges, templates)
+    matcher.coarse_matches = matcher.fine_matches = 0
+
+    totals = {"naive_ms": 0.0, "multiscale_ms": 0.0, "naive_correct": 0, "multiscale_correct": 0, "agree": 0}
+    trials = 0
+    for _ in range(args.trials):
+        for scale in test_scales:
+            name, image = templates[rng.integers(len(templates))]
+            piece = transform_template(to_gray(image), scale)
+            height, width = piece.shape[:2]
+            if height >= edges.shape[0] or width >= edges.shape[1]:
+                continue
+            x = int(rng.integers(0, edges.shape[1] - width))
+            y = int(rng.integers(0, edges.shape[0] - height))
+            background = edges.copy()
+            np.maximum(background[y:y + height, x:x + width], piece, out=background[y:y + height, x:x + width])
+
+            start = time.perf_counter()
+            naive = naive_match(background, templates)
+            totals["naive_ms"] += (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            fast = matcher.match(background, templates)
+            totals["multiscale_ms"] += (time.perf_counter() - start) * 1000
+
+            totals["naive_correct"] += naive is not None and abs(naive["location"][0] - x) <= 2
+            totals["multiscale_correct"] += fast is not None and abs(fast["location"][0] - x) <= 2
+            totals["agree"] += (naive is not None and fast is not None
+                                and abs(naive["location"][0] - fast["location"][0]) <= 2)
+            trials += 1
+
+    print(json.dumps({
+        "templates": len(templates),
+        "scales": len(DEFAULT_SCALES),
+        "trials": trials,
+        "naive_ms_mean": round(totals["naive_ms"] / trials, 3),
+        "multiscale_ms_mean": round(totals["multiscale_ms"] / trials, 3),
+        "speedup": round(totals["naive_ms"] / max(totals["multiscale_ms"], 1e-9), 2),
+        "naive_accuracy": round(totals["naive_correct"] / trials, 3),
+        "multiscale_accuracy": round(totals["multiscale_correct"] / trials, 3),
+        "agreement": round(totals["agree"] / trials, 3),
+        "matches_per_solve": {k: v / trials for k, v in matcher.stats().items()},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class BufferArena:
+    """
+    Bộ đệm numpy dùng lại giữa các lần giải, để các hàm OpenCV ghi thẳng vào `dst`
+    thay vì cấp phát mảng mới mỗi request. Buffer được định danh bằng
+    (tên, shape, dtype); khi vượt max_buffers thì bỏ buffer ít dùng nhất.
+
+    Buffer trả về bị ghi đè ở lần gọi sau với cùng tên, nên dữ liệu cần giữ lâu
+    hơn một lần giải phải được .copy() ra.
+    """
+
+    def __init__(self, max_buffers=64):
+        self.max_buffers = max_buffers
+        self.allocations = 0
+        self.requests = 0
+        self._buffers = OrderedDict()
+
+    def get(self, name, shape, dtype=np.uint8):
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        self.requests += 1
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+            self.allocations += 1
+            self._buffers[key] = buffer
+            if len(self._buffers) > self.max_buffers:
+                self._buffers.popitem(last=False)
+        else:
+            self._buffers.move_to_end(key)
+        return buffer
+
+    def stats(self):
+        return {
+            "buffers": len(self._buffers),
+            "bytes": sum(b.nbytes for b in self._buffers.values()),
+            "allocations": self.allocations,
+            "requests": self.requests,
+        }
+
+
+_local = threading.local()
+
+
+def get_arena():
+    """Arena riêng cho từng thread của worker hiện tại."""
+    arena = getattr(_local, "arena", None)
+    if arena is None:
+        arena = _local.arena = BufferArena()
+    return arena
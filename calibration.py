@@ -0,0 +1,209 @@
+"""
+Hiệu chỉnh bảng puzzle_left -> slider_left (captcha.json) từ dữ liệu thật mà
+/api/save-captcha-data (autoticket.py) thu thập trong datacaptcha/captcha_data.json.
+
+    python calibration.py fit --samples datacaptcha/captcha_data.json --out captcha.json
+    python calibration.py fit ... --interval 3600     # chạy lại mỗi giờ
+
+Mẫu được gộp với bảng neo (bản chép của bảng làm tay, trọng số --base-weight mỗi điểm), fit hàm
+đơn điệu không giảm bằng isotonic regression (PAV), rồi sinh lại bảng theo từng giá trị
+slider_left nguyên như định dạng cũ. Solver tự đọc lại bảng khi file thay đổi.
+"""
+import argparse
+import bisect
+import json
+import math
+import os
+import shutil
+import time
+
+
+def stream_samples(path):
+    """Các cặp (puzzleLeft, sliderLeft) hợp lệ từ file JSON (mảng) hoặc JSON Lines."""
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    stripped = content.lstrip()
+    if stripped.startswith("["):
+        entries = json.loads(stripped)
+    else:
+        entries = (json.loads(line) for line in content.splitlines() if line.strip())
+    for entry in entries:
+        try:
+            x = float(str(entry["puzzleLeft"]).replace("px", "").strip())
+            y = float(str(entry["sliderLeft"]).replace("px", "").strip())
+        except (KeyError, TypeError, ValueError):
+            continue
+        if math.isfinite(x) and math.isfinite(y):
+            yield x, y
+
+
+def isotonic_fit(points):
+    """
+    Isotonic regression (pool adjacent violators) trên các điểm (x, y, trọng số)
+    Returns:
+        Danh sách knot (x, y) với x tăng dần và y không giảm
+    """
+    grouped = {}
+    for x, y, w in points:
+        sum_w, sum_wy = grouped.get(x, (0.0, 0.0))
+        grouped[x] = (sum_w + w, sum_wy + w * y)
+
+    # Mỗi block: [tổng trọng số, tổng w*x, tổng w*y]
+    blocks = []
+    for x in sorted(grouped):
+        w, wy = grouped[x]
+        blocks.append([w, w * x, wy])
+        while len(blocks) > 1 and blocks[-2][2] / blocks[-2][0] > blocks[-1][2] / blocks[-1][0]:
+            w2, wx2, wy2 = blocks.pop()
+            blocks[-1][0] += w2
+            blocks[-1][1] += wx2
+            blocks[-1][2] += wy2
+    return [(wx / w, wy / w) for w, wx, wy in blocks]
+
+
+def table_from_knots(knots, step=1):
+    """Sinh bảng {puzzle_left, slider_left} cho từng slider_left nguyên bằng nội suy ngược."""
+    if not knots:
+        return []
+    table = []
+    j = 0
+    s = math.ceil(knots[0][1])
+    while s <= knots[-1][1]:
+        while j + 1 < len(knots) and knots[j + 1][1] < s:
+            j += 1
+        x0, y0 = knots[j]
+        if j + 1 < len(knots) and knots[j + 1][1] > y0 and y0 < s:
+            x1, y1 = knots[j + 1]
+            x = x0 + (s - y0) * (x1 - x0) / (y1 - y0)
+        else:
+            x = x0
+        table.append({"puzzle_left": round(x, 3), "slider_left": s})
+        s += step
+    return table
+
+
+def fit_table(samples, base_table=None, base_weight=1.0):
+    points = [(x, y, 1.0) for x, y in samples]
+    for entry in base_table or []:
+        if entry.get("puzzle_left") is not None and entry.get("slider_left") is not None:
+            points.append((float(entry["puzzle_left"]), float(entry["slider_left"]), base_weight))
+    return table_from_knots(isotonic_fit(points))
+
+
+class SliderCalibration:
+    """
+    Bảng puzzle_left -> slider_left tra cứu O(1): trục puzzle_left được chia thành các
+    bucket đều nhau, mỗi bucket nhớ sẵn đoạn knot chứa điểm đầu bucket.
+    """
+
+    def __init__(self, table, buckets_per_knot=2):
+        knots = {}
+        # Giữ entry đầu tiên cho mỗi puzzle_left như cách tra cứu cũ
+        for entry in table:
+            x, y = entry.get("puzzle_left"), entry.get("slider_left")
+            if x is not None and y is not None and x not in knots:
+                knots[x] = y
+        self.xs = sorted(knots)
+        self.ys = [knots[x] for x in self.xs]
+        self._bucket_count = max(1, len(self.xs) * buckets_per_knot)
+        if len(self.xs) > 1 and self.xs[-1] > self.xs[0]:
+            self._scale = self._bucket_count / (self.xs[-1] - self.xs[0])
+            self._bucket_segment = [
+                max(0, bisect.bisect_right(self.xs, self.xs[0] + b / self._scale) - 1)
+                for b in range(self._bucket_count + 1)
+            ]
+        else:
+            self._scale = 0.0
+            self._bucket_segment = [0]
+
+    @classmethod
+    def from_file(cls, json_path):
+        with open(json_path, "r") as f:
+            return cls(json.load(f))
+
+    def __len__(self):
+        return len(self.xs)
+
+    def _segment(self, x):
+        """Chỉ số j lớn nhất với xs[j] <= x (x nằm trong khoảng xs)."""
+        j = self._bucket_segment[min(self._bucket_count, int((x - self.xs[0]) * self._scale))]
+        while j + 1 < len(self.xs) and self.xs[j + 1] <= x:
+            j += 1
+        return j
+
+    def snap_up(self, x):
+        """(puzzle_left, slider_left) của entry gần nhất có puzzle_left >= x, hoặc entry lớn nhất."""
+        if x <= self.xs[0]:
+            k = 0
+        elif x > self.xs[-1]:
+            k = len(self.xs) - 1
+        else:
+            j = self._segment(x)
+            k = j if self.xs[j] >= x else j + 1
+        return self.xs[k], self.ys[k]
+
+    def interpolate(self, x):
+        """slider_left nội suy tuyến tính theo puzzle_left (giữ nguyên giá trị biên ngoài khoảng)."""
+        if x <= self.xs[0]:
+            return float(self.ys[0])
+        if x >= self.xs[-1]:
+            return float(self.ys[-1])
+        j = self._segment(x)
+        x0, x1 = self.xs[j], self.xs[j + 1]
+        y0, y1 = self.ys[j], self.ys[j + 1]
+        return float(y0 + (x - x0) * (y1 - y0) / (x1 - x0))
+
+
+def regenerate_table(samples_path, base_path, out_path, base_weight=1.0, min_samples=20):
+    """
+    Fit lại bảng và ghi nguyên tử ra out_path
+    Returns:
+        Số mẫu đã dùng, hoặc 0 nếu chưa đủ mẫu (bảng giữ nguyên)
+    """
+    samples = list(stream_samples(samples_path)) if os.path.exists(samples_path) else []
+    if len(samples) < min_samples:
+        return 0
+    # Lần đầu: lưu lại bảng làm tay làm điểm neo cố định, để các lần fit sau không
+    # lấy bảng đã fit làm gốc (mẫu cũ sẽ bị tính lặp lại)
+    if base_path and not os.path.exists(base_path) and os.path.exists(out_path):
+        shutil.copyfile(out_path, base_path)
+    base_table = []
+    if base_path and os.path.exists(base_path):
+        with open(base_path, "r") as f:
+            base_table = json.load(f)
+    table = fit_table(samples, base_table, base_weight)
+    if not table:
+        return 0
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("[\n" + ",\n".join("    " + json.dumps(entry) for entry in table) + "\n  ]")
+    os.replace(tmp_path, out_path)
+    return len(samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_fit = sub.add_parser("fit", help="Fit lại bảng từ mẫu thu thập được")
+    p_fit.add_argument("--samples", default=os.path.join("datacaptcha", "captcha_data.json"))
+    p_fit.add_argument("--base", default="captcha.base.json",
+                       help="Bảng neo; nếu chưa có sẽ được chép từ --out ở lần chạy đầu")
+    p_fit.add_argument("--out", default="captcha.json")
+    p_fit.add_argument("--base-weight", type=float, default=1.0)
+    p_fit.add_argument("--min-samples", type=int, default=20)
+    p_fit.add_argument("--interval", type=float, default=0, help="Giây giữa hai lần fit lại (0 = chạy một lần)")
+    args = parser.parse_args(argv)
+
+    while True:
+        used = regenerate_table(args.samples, args.base, args.out, args.base_weight, args.min_samples)
+        if used:
+            print(f"Đã fit lại {args.out} từ {used} mẫu")
+        else:
+            print(f"Chưa đủ {args.min_samples} mẫu, giữ nguyên {args.out}")
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
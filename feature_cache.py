@@ -0,0 +1,167 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+EVICTION_POLICIES = ("lru", "lfu", "fifo")
+
+
+class FeatureCache:
+    """
+    Cache edge map đã tiền xử lý (resize + Canny + cắt nền) của ảnh nền, để ảnh nền
+    lặp lại đi thẳng tới bước khớp template.
+
+    Hai tầng:
+    - Bộ nhớ: tối đa max_entries mảng, bỏ bớt theo policy "lru" | "lfu" | "fifo"
+    - Đĩa (tùy chọn): file .npy trong disk_dir, đọc lại bằng memmap, tối đa
+      disk_max_entries file (xóa file cũ nhất trước). Nhiều worker dùng chung được.
+
+    Mảng trả về là chỉ đọc; cần vẽ lên thì .copy() ra trước.
+    """
+
+    def __init__(self, max_entries=256, policy="lru", disk_dir=None, disk_max_entries=4096):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Policy không được hỗ trợ: {policy} (chọn một trong {', '.join(EVICTION_POLICIES)})")
+        self.max_entries = max_entries
+        self.policy = policy
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._uses = {}
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """FEATURE_CACHE_SIZE (0 = tắt), FEATURE_CACHE_POLICY, FEATURE_CACHE_DIR, FEATURE_CACHE_DISK_SIZE"""
+        return cls(
+            max_entries=int(os.environ.get("FEATURE_CACHE_SIZE", "256")),
+            policy=os.environ.get("FEATURE_CACHE_POLICY", "lru"),
+            disk_dir=os.environ.get("FEATURE_CACHE_DIR") or None,
+            disk_max_entries=int(os.environ.get("FEATURE_CACHE_DISK_SIZE", "4096")),
+        )
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 or bool(self.disk_dir)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.npy")
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self.hits += 1
+                self._uses[key] += 1
+                if self.policy == "lru":
+                    self._entries.move_to_end(key)
+                return value
+        value = self._load_from_disk(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, value)
+        return value
+
+    def put(self, key, value):
+        """Lưu bản sao chỉ đọc của value, trả về bản sao đó."""
+        value = np.array(value, copy=True)
+        value.setflags(write=False)
+        with self._lock:
+            self._store(key, value)
+        self._save_to_disk(key, value)
+        return value
+
+    def _store(self, key, value):
+        if self.max_entries <= 0:
+            return
+        if key not in self._entries:
+            while len(self._entries) >= self.max_entries:
+                self._evict_one()
+        self._entries[key] = value
+        self._uses[key] = self._uses.get(key, 0) + 1
+
+    def _evict_one(self):
+        if self.policy == "lfu":
+            # Ít dùng nhất; hòa thì bỏ entry cũ nhất (thứ tự chèn của OrderedDict)
+            victim = min(self._entries, key=self._uses.__getitem__)
+        else:
+            victim = next(iter(self._entries))
+        del self._entries[victim]
+        del self._uses[victim]
+        self.evictions += 1
+
+    def _load_from_disk(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            return np.load(self._disk_path(key), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def _save_to_disk(self, key, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, value)
+        os.replace(tmp_path, path)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        files = [os.path.join(self.disk_dir, f) for f in os.listdir(self.disk_dir) if f.endswith(".npy")]
+        if len(files) <= self.disk_max_entries:
+            return
+        files.sort(key=lambda f: os.path.getmtime(f))
+        for path in files[:len(files) - self.disk_max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._uses.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "policy": self.policy,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": sum(v.nbytes for v in self._entries.values() if not isinstance(v, np.memmap)),
+                "disk_dir": self.disk_dir,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+            }
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_feature_cache():
+    """Cache dùng chung trong tiến trình, cấu hình từ biến môi trường ở lần gọi đầu."""
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                _default_cache = FeatureCache.from_env()
+    return _default_cache
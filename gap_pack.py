@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import cv2
+import numpy as np
+
+PACK_MAGIC = b"GAPPACK1"
+PACK_ALIGN = 64
+# magic (8 byte) + độ dài index (uint64, little-endian)
+HEADER_STRUCT = struct.Struct("<8sQ")
+
+
+def _is_gap_filename(filename):
+    return filename.startswith("image_gap_") and filename.endswith(".png")
+
+
+def _gap_sort_key(filename):
+    stem = filename[len("image_gap_"):-len(".png")]
+    return (0, int(stem), filename) if stem.isdigit() else (1, 0, filename)
+
+
+def list_gap_files(folder):
+    """Danh sách file image_gap_*.png trong thư mục, sắp theo số thứ tự."""
+    if not os.path.isdir(folder):
+        return []
+    return sorted((f for f in os.listdir(folder) if _is_gap_filename(f)), key=_gap_sort_key)
+
+
+def template_hash(image):
+    """SHA-1 trên shape + dữ liệu thô, dùng để dò trùng lặp mà không cần giải mã PNG."""
+    digest = hashlib.sha1(str(image.shape).encode("ascii"))
+    digest.update(np.ascontiguousarray(image).tobytes())
+    return digest.hexdigest()
+
+
+def write_pack(pack_path, templates):
+    """
+    Ghi packfile từ danh sách (name, image)
+    Parameters:
+        pack_path: Đường dẫn file đầu ra
+        templates: Iterable các cặp (tên, ảnh uint8)
+    Returns:
+        Danh sách entry trong index
+    """
+    entries = []
+    blobs = []
+    offset = 0
+    for name, image in templates:
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        entries.append({
+            "name": name,
+            "offset": offset,
+            "shape": list(image.shape),
+            "sha1": template_hash(image),
+        })
+        blobs.append(image)
+        offset += image.nbytes
+
+    index_bytes = json.dumps({"version": 1, "templates": entries}, ensure_ascii=False).encode("utf-8")
+    header_size = HEADER_STRUCT.size + len(index_bytes)
+    padding = (-header_size) % PACK_ALIGN
+
+    tmp_path = pack_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER_STRUCT.pack(PACK_MAGIC, len(index_bytes)))
+        f.write(index_bytes)
+        f.write(b"\0" * padding)
+        for blob in blobs:
+            f.write(blob.tobytes())
+    os.replace(tmp_path, pack_path)
+    return entries
+
+
+def read_pack_index(pack_path):
+    """Đọc header + index, trả về (offset vùng dữ liệu, danh sách entry)."""
+    with open(pack_path, "rb") as f:
+        header = f.read(HEADER_STRUCT.size)
+        if len(header) != HEADER_STRUCT.size:
+            raise ValueError(f"File {pack_path} không phải packfile hợp lệ.")
+        magic, index_len = HEADER_STRUCT.unpack(header)
+        if magic != PACK_MAGIC:
+            raise ValueError(f"File {pack_path} không phải packfile hợp lệ.")
+        index = json.loads(f.read(index_len).decode("utf-8"))
+    header_size = HEADER_STRUCT.size + index_len
+    data_offset = header_size + (-header_size) % PACK_ALIGN
+    return data_offset, index["templates"]
+
+
+class GapPack:
+    """
+    Kho template gap chỉ đọc, map vào bộ nhớ bằng numpy.memmap.
+    Nhiều worker mở cùng một file sẽ dùng chung page cache của hệ điều hành,
+    không phải mở/giải mã từng file PNG.
+    """
+
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        data_offset, self.entries = read_pack_index(pack_path)
+        data_size = sum(int(np.prod(e["shape"])) for e in self.entries)
+        if data_size:
+            self._data = np.memmap(pack_path, dtype=np.uint8, mode="r", offset=data_offset, shape=(data_size,))
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+        self._by_name = {e["name"]: e for e in self.entries}
+        self._by_hash = {e["sha1"]: e["name"] for e in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def get(self, name):
+        entry = self._by_name[name]
+        size = int(np.prod(entry["shape"]))
+        return self._data[entry["offset"]:entry["offset"] + size].reshape(entry["shape"])
+
+    def find_by_hash(self, sha1):
+        return self._by_hash.get(sha1)
+
+    def items(self):
+        for entry in self.entries:
+            yield entry["name"], self.get(entry["name"])
+
+    def touch(self):
+        """Đọc một byte trên mỗi page để nạp trước packfile vào page cache."""
+        if not len(self._data):
+            return 0
+        return int(self._data[::mmap.PAGESIZE].sum())
+
+
+_open_packs = {}
+
+
+def open_gap_pack(pack_path):
+    """Mở packfile và giữ lại trong tiến trình; tự mở lại khi file được ghi đè."""
+    mtime = os.path.getmtime(pack_path)
+    cached = _open_packs.get(pack_path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, GapPack(pack_path))
+        _open_packs[pack_path] = cached
+    return cached[1]
+
+
+def export_folder_to_pack(folder, pack_path):
+    """Đóng gói toàn bộ image_gap_*.png trong thư mục thành một packfile."""
+    def iter_templates():
+        for filename in list_gap_files(folder):
+            image = cv2.imread(os.path.join(folder, filename))
+            if image is None:
+                print(f"Bỏ qua file không đọc được: {filename}")
+                continue
+            yield filename, image
+
+    return write_pack(pack_path, iter_templates())
+
+
+def import_pack_to_folder(pack_path, folder):
+    """Giải nén packfile ra thư mục PNG (ghi đè file trùng tên)."""
+    os.makedirs(folder, exist_ok=True)
+    pack = GapPack(pack_path)
+    for name, image in pack.items():
+        cv2.imwrite(os.path.join(folder, name), np.asarray(image))
+    return len(pack)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chuyển đổi giữa thư mục gap_image và packfile")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="Thư mục PNG -> packfile")
+    p_export.add_argument("folder", nargs="?", default="gap_image")
+    p_export.add_argument("pack", nargs="?", default="gap_image.pack")
+
+    p_import = sub.add_parser("import", help="Packfile -> thư mục PNG")
+    p_import.add_argument("pack", nargs="?", default="gap_image.pack")
+    p_import.add_argument("folder", nargs="?", default="gap_image")
+
+    p_info = sub.add_parser("info", help="In index của packfile")
+    p_info.add_argument("pack", nargs="?", default="gap_image.pack")
+
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        entries = export_folder_to_pack(args.folder, args.pack)
+        print(f"Đã đóng gói {len(entries)} template vào {args.pack}")
+    elif args.command == "import":
+        count = import_pack_to_folder(args.pack, args.folder)
+        print(f"Đã giải nén {count} template vào {args.folder}")
+    else:
+        _, entries = read_pack_index(args.pack)
+        for entry in entries:
+            print(f"{entry['name']}\t{'x'.join(map(str, entry['shape']))}\t{entry['sha1']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Load test cho các API FastAPI (main.py / autoticket.py) với server ảnh giả và
+Google Sheets giả chạy trong cùng tiến trình.
+
+    python loadtest.py --target main --concurrency 16 --duration 30 \\
+        --mix verify=4,add=2,delete=1,latest=3 --output report.json
+
+In ra (và ghi vào --output nếu có) báo cáo JSON: throughput, p50/p95/p99 latency
+và tỉ lệ lỗi cho từng endpoint (4xx đếm riêng ở client_errors; với verify/solve
+mọi mã khác 2xx đều là lỗi).
+"""
+import argparse
+import atexit
+import builtins
+import importlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from sheets_breaker import parse_a1
+
+# Các thao tác theo từng app: tên -> (method, đường dẫn)
+TARGET_OPS = {
+    "main": {
+        "verify": ("POST", "/api/verify-captcha"),
+        "add": ("POST", "/api/add-ticket"),
+        "delete": ("GET", "/api/delete-ticket"),
+        "latest": ("GET", "/api/latest-ticket/{id_profile}"),
+    },
+    "autoticket": {
+        "solve": ("POST", "/api/solve-captcha"),
+        "add": ("POST", "/api/add-ticket"),
+        "delete": ("GET", "/api/delete-ticket"),
+        "latest": ("GET", "/api/latest-ticket"),
+    },
+}
+# Thao tác giải captcha: mọi mã khác 2xx đều là lỗi (400 "Failed to solve" cũng là giải hỏng).
+# Thao tác ticket: 4xx có thể là kết quả hợp lệ (xóa ticket không còn) nên chỉ đếm riêng
+SOLVE_OPS = {"verify", "solve"}
+DEFAULT_MIX = {
+    "main": "verify=4,add=2,delete=1,latest=3",
+    "autoticket": "solve=4,add=2,delete=1,latest=3",
+}
+
+
+### Google Sheets giả ###
+class _Request:
+    def __init__(self, fn, latency, error_rate=0.0):
+        self._fn = fn
+        self._latency = latency
+        self._error_rate = error_rate
+
+    def execute(self):
+        if self._latency:
+            time.sleep(self._latency)
+        if self._error_rate and random.random() < self._error_rate:
+            raise TimeoutError("fake Sheets timeout")
+        return self._fn()
+
+
+class FakeSheetsService:
+    """
+    Giả lập phần API Google Sheets v4 mà main.py / autoticket.py dùng:
+    spreadsheets().values().get/update/append/clear và spreadsheets().batchUpdate.
+    """
+
+    def __init__(self, latency=0.0, rows=None, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._grid = [list(r) for r in rows or []]
+        self.calls = 0
+
+    # service.spreadsheets() và .values() trả về chính đối tượng này
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _request(self, fn):
+        def locked():
+            with self._lock:
+                self.calls += 1
+                return fn()
+        return _Request(locked, self.latency, self.error_rate)
+
+    def _cell(self, row, col):
+        if row - 1 < len(self._grid) and col < len(self._grid[row - 1]):
+            return self._grid[row - 1][col]
+        return ""
+
+    def _set(self, row, col, value):
+        while len(self._grid) < row:
+            self._grid.append([])
+        cells = self._grid[row - 1]
+        while len(cells) <= col:
+            cells.append("")
+        cells[col] = value
+
+    @staticmethod
+    def _trim(values):
+        while values and values[-1] in ("", []):
+            values.pop()
+        return values
+
+    def get(self, spreadsheetId=None, range=None, majorDimension="ROWS"):
+        def run():
+            row_start, row_end, col_start, col_end = parse_a1(range)
+            row_end = min(row_end or len(self._grid), len(self._grid))
+            rows = [self._trim([self._cell(r, c) for c in builtins.range(col_start, col_end + 1)])
+                    for r in builtins.range(row_start, row_end + 1)]
+            if majorDimension == "COLUMNS":
+                rows = [self._trim([row[i] if i < len(row) else "" for row in rows])
+                        for i in builtins.range(col_end - col_start + 1)]
+            rows = self._trim(rows)
+            return {"range": range, "values": rows} if rows else {"range": range}
+        return self._request(run)
+
+    def update(self, spreadsheetId=None, range=None, valueInputOption=None, body=None):
+        def run():
+            row_start, _, col_start, _ = parse_a1(range)
+            for r, row in enumerate(body.get("values", [])):
+                for c, value in enumerate(row):
+                    self._set(row_start + r, col_start + c, str(value))
+            return {"updatedRange": range}
+        return self._request(run)
+
+    def append(self, spreadsheetId=None, range=None, valueInputOption=None, insertDataOption=None, body=None):
+        def run():
+            _, _, col_start, _ = parse_a1(range)
+            last = len(self._trim([self._trim(list(r)) for r in self._grid]))
+            for r, row in enumerate(body.get("values", [])):
+                for c, value in enumerate(row):
+                    self._set(last + 1 + r, col_start + c, str(value))
+            return {"updates": {"updatedRows": len(body.get("values", []))}}
+        return self._request(run)
+
+    def clear(self, spreadsheetId=None, range=None, body=None):
+        def run():
+            row_start, row_end, col_start, col_end = parse_a1(range)
+            for r in builtins.range(row_start, min(row_end or len(self._grid), len(self._grid)) + 1):
+                for c in builtins.range(col_start, col_end + 1):
+                    if self._cell(r, c):
+                        self._set(r, c, "")
+            return {"clearedRange": range}
+        return self._request(run)
+
+    def batchUpdate(self, spreadsheetId=None, body=None):
+        return self._request(lambda: {"replies": []})
+
+
+### Server ảnh giả ###
+def start_image_server(files, host="127.0.0.1", port=0):
+    """Phục vụ {đường dẫn: bytes} qua HTTP, trả về (server, base_url)."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            data = files.get(self.path.split("?", 1)[0])
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def start_app(target, fake_sheets, port):
+    """Chạy app FastAPI trong thread riêng với Sheets giả."""
+    import uvicorn
+
+    # Lệnh ghi giả vẫn mang SPREADSHEET_ID thật: dùng outbox tạm riêng để chúng không bao giờ
+    # bị app thật phát lại lên sheet thật (biến môi trường được đọc khi app bọc service lần đầu)
+    outbox_dir = tempfile.mkdtemp(prefix="loadtest-outbox-")
+    atexit.register(shutil.rmtree, outbox_dir, ignore_errors=True)
+    os.environ["SHEETS_OUTBOX_PATH"] = os.path.join(outbox_dir, "sheets_outbox.db")
+    module = importlib.import_module(target)
+    module.sheets_service = fake_sheets
+    server = uvicorn.Server(uvicorn.Config(module.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("App không khởi động được trong 30 giây")
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+### Sinh tải ###
+def parse_mix(mix, ops):
+    weights = {}
+    for part in filter(None, (p.strip() for p in mix.split(","))):
+        name, _, weight = part.partition("=")
+        if name not in ops:
+            raise ValueError(f"Thao tác không hợp lệ '{name}', chọn trong: {', '.join(ops)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class LoadRunner:
+    def __init__(self, target, base_url, image_base_url, weights, profiles):
+        self.target = target
+        self.base_url = base_url
+        self.image_base_url = image_base_url
+        self.ops = TARGET_OPS[target]
+        self.names = list(weights)
+        self.weights = [weights[n] for n in self.names]
+        self.profiles = profiles
+        self.added_tickets = []
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def _request(self, session, name):
+        method, path = self.ops[name]
+        url = self.base_url + path
+        kwargs = {"timeout": 60}
+        gap_url = f"{self.image_base_url}/gap.png"
+        bg_url = f"{self.image_base_url}/bg.png"
+        if name == "verify":
+            kwargs["json"] = {"gap_image_url": gap_url, "bg_image_url": bg_url}
+        elif name == "solve":
+            kwargs["data"] = {"shadow": gap_url, "back": bg_url}
+        elif name == "add":
+            ticket = uuid.uuid4().hex
+            kwargs["data"] = {"ticket": ticket}
+            with self._lock:
+                self.added_tickets.append(ticket)
+        elif name == "delete":
+            with self._lock:
+                ticket = self.added_tickets.pop(0) if self.added_tickets else uuid.uuid4().hex
+            kwargs["params"] = {"ticket": ticket}
+        elif name == "latest":
+            url = url.format(id_profile=random.choice(self.profiles))
+        return session.request(method, url, **kwargs)
+
+    def worker(self, deadline, remaining):
+        session = requests.Session()
+        while time.time() < deadline:
+            if remaining is not None:
+                with self._lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            name = random.choices(self.names, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                status_code = self._request(session, name).status_code
+            except requests.RequestException:
+                status_code = None
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.samples.append((name, elapsed, status_code))
+
+    @staticmethod
+    def is_error(name, status_code):
+        if status_code is None or status_code >= 500:
+            return True
+        return name in SOLVE_OPS and not 200 <= status_code < 300
+
+    def run(self, concurrency, duration, total_requests=None):
+        remaining = [total_requests] if total_requests else None
+        deadline = time.time() + duration
+        threads = [threading.Thread(target=self.worker, args=(deadline, remaining)) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.report(time.perf_counter() - start, concurrency)
+
+    def report(self, elapsed, concurrency):
+        endpoints = {}
+        for name in self.names:
+            latencies = sorted(ms for n, ms, _ in self.samples if n == name)
+            errors = sum(1 for n, _, code in self.samples if n == name and self.is_error(n, code))
+            endpoints[name] = {
+                "path": self.ops[name][1],
+                "count": len(latencies),
+                "errors": errors,
+                "client_errors": sum(1 for n, _, code in self.samples
+                                     if n == name and code is not None and 400 <= code < 500),
+                "error_rate": round(errors / len(latencies), 4) if latencies else None,
+                "throughput_rps": round(len(latencies) / elapsed, 2),
+                "p50_ms": _round(percentile(latencies, 50)),
+                "p95_ms": _round(percentile(latencies, 95)),
+                "p99_ms": _round(percentile(latencies, 99)),
+                "max_ms": _round(latencies[-1] if latencies else None),
+            }
+        total_errors = sum(1 for n, _, code in self.samples if self.is_error(n, code))
+        return {
+            "target": self.target,
+            "base_url": self.base_url,
+            "concurrency": concurrency,
+            "duration_s": round(elapsed, 3),
+            "total_requests": len(self.samples),
+            "throughput_rps": round(len(self.samples) / elapsed, 2),
+            "error_rate": round(total_errors / len(self.samples), 4) if self.samples else None,
+            "endpoints": endpoints,
+        }
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=sorted(TARGET_OPS), default="main")
+    parser.add_argument("--base-url", default=None, help="Đánh vào server có sẵn thay vì tự chạy app với Sheets giả")
+    parser.add_argument("--port", type=int, default=3100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20, help="Giây")
+    parser.add_argument("--requests", type=int, default=None, help="Dừng sau số request này (nếu đến trước --duration)")
+    parser.add_argument("--mix", default=None, help="Tỉ trọng thao tác, ví dụ verify=4,add=2,delete=1,latest=3")
+    parser.add_argument("--gap-image", default=os.path.join("gap_image", "image_gap_1.png"))
+    parser.add_argument("--bg-image", default=os.path.join("result", "result.png"))
+    parser.add_argument("--sheets-latency-ms", type=float, default=0, help="Độ trễ giả lập cho mỗi lệnh Sheets")
+    parser.add_argument("--sheets-error-rate", type=float, default=0, help="Tỉ lệ lệnh Sheets giả bị timeout (thử chế độ suy giảm)")
+    parser.add_argument("--profiles", type=int, default=20, help="Số ID Profile điền sẵn trong sheet giả")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    with open(args.gap_image, "rb") as f:
+        gap_bytes = f.read()
+    with open(args.bg_image, "rb") as f:
+        bg_bytes = f.read()
+    image_server, image_base_url = start_image_server({"/gap.png": gap_bytes, "/bg.png": bg_bytes})
+
+    profiles = [f"profile-{i}" for i in range(1, args.profiles + 1)]
+    app_server = None
+    base_url = args.base_url
+    if base_url is None:
+        # main.py lưu ID Profile ở cột A, ticket được điền vào hàng có cột B trống
+        seed_rows = [[p] for p in profiles] if args.target == "main" else []
+        fake_sheets = FakeSheetsService(latency=args.sheets_latency_ms / 1000, rows=[[]] + seed_rows,
+                                       error_rate=args.sheets_error_rate)
+        app_server, base_url = start_app(args.target, fake_sheets, args.port)
+
+    runner = LoadRunner(args.target, base_url, image_base_url,
+                        parse_mix(args.mix or DEFAULT_MIX[args.target], TARGET_OPS[args.target]), profiles)
+    report = runner.run(args.concurrency, args.duration, args.requests)
+
+    if app_server is not None:
+        app_server.should_exit = True
+    image_server.shutdown()
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
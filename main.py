@@ -1,15 +1,22 @@
-from fastapi import FastAPI,Body, Form, HTTPException
+from fastapi import FastAPI,Body, File, Form, Header, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+from fastapi.responses import JSONResponse
 from datetime import datetime, timedelta
 import pytz
 import json
 import asyncio
-from collections import deque
+import socket
 import uvicorn
 import re
-from autocaptchavip import PuzzleCaptchaSolver
+import os
+import sys
+import base64
+import hashlib
+import threading
+from solve_jobs import JobStore, SingleFlight
+from shared_state import create_state_backend
+from solve_profiler import SolveProfiler, profile_requested
+from sheets_breaker import CircuitOpenError, guard_sheets_service
 app = FastAPI(title="Ticket Tracking API")
 
 # CORS Configuration
@@ -27,22 +34,52 @@ SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SPREADSHEET_ID = "1ExRHONdCvGq--lZggVEQFGHhhkMYtCuZiOiOisbWTj0"
 SHEET_NAME = 'huy1'
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+GAP_PACK_PATH = os.environ.get("GAP_PACK_PATH", "gap_image.pack")
+# "eager": khởi tạo Sheets đồng bộ trước khi nhận request (mặc định)
+# "lazy": nhận request ngay, khởi tạo Sheets + warm-up solver ở background
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "eager")
+# Timeout (giây) cho mỗi request tới Google Sheets
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", "10"))
+
+# Trạng thái ticket dùng chung giữa các worker (xem shared_state.create_state_backend)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEADER_TTL = 30
+ticket_state = create_state_backend()
 
 # Global variables
-ticket_queue = deque()
 vietnam_tz = pytz.timezone('Asia/Ho_Chi_Minh')
 sheets_service = None
+# sheets_service bọc circuit breaker + bản sao cục bộ + outbox (xem sheets_breaker)
+sheets_guard = None
+# Endpoint ticket chạy trong threadpool nên nhiều thread có thể cùng khởi tạo lần đầu
+sheets_init_lock = threading.Lock()
+readiness = {"sheets": False, "solver": False, "errors": {}}
+solve_flight = SingleFlight()
+# Trạng thái job ghi ra backend dùng chung (nếu có) để poll qua worker nào cũng thấy
+solve_jobs = JobStore(store=ticket_state if ticket_state.shared else None)
+# Profile discern khi có header "X-Profile-Solve: 1" hoặc lấy mẫu 1/PROFILE_SAMPLE_EVERY request
+solve_profiler = SolveProfiler.from_env()
 
 ### Helper Functions ###
 def init_google_sheets():
-    global sheets_service
+    global sheets_service, sheets_guard
     try:
-        if sheets_service is None:
-            with open(CREDENTIALS_FILE, 'r') as file:
-                creds_info = json.load(file)
-            creds = Credentials.from_service_account_info(creds_info, scopes=SCOPES)
-            sheets_service = build('sheets', 'v4', credentials=creds)
-        return sheets_service
+        with sheets_init_lock:
+            if sheets_service is None:
+                # Import muộn: googleapiclient nặng, không cần cho các endpoint giải captcha
+                import httplib2
+                from google.oauth2.service_account import Credentials
+                from google_auth_httplib2 import AuthorizedHttp
+                from googleapiclient.discovery import build
+                with open(CREDENTIALS_FILE, 'r') as file:
+                    creds_info = json.load(file)
+                creds = Credentials.from_service_account_info(creds_info, scopes=SCOPES)
+                # Có timeout để Sheets chậm không treo request vô hạn; breaker ngắt mạch sau vài lần lỗi
+                http = AuthorizedHttp(creds, http=httplib2.Http(timeout=SHEETS_TIMEOUT))
+                sheets_service = build('sheets', 'v4', http=http)
+            if sheets_guard is None or sheets_guard.service is not sheets_service:
+                sheets_guard = guard_sheets_service(sheets_service, owner=WORKER_ID)
+            return sheets_guard
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Google Sheets connection error: {str(e)}")
 
@@ -85,6 +122,8 @@ def ensure_headers_and_format(service):
                 }]
             }
         ).execute()
+    except CircuitOpenError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Header configuration error: {str(e)}")
 
@@ -100,7 +139,6 @@ def parse_timestamp(timestamp_str):
             raise ValueError(f"Invalid timestamp format: {timestamp_str}")
 
 def check_existing_tickets(service):
-    global ticket_queue
     try:
         result = service.spreadsheets().values().get(
             spreadsheetId=SPREADSHEET_ID, 
@@ -123,7 +161,7 @@ def check_existing_tickets(service):
                 if now >= expiry_time:
                     expired_rows.append(i)
                 else:
-                    ticket_queue.append((i, expiry_time))
+                    ticket_state.push_expiry(i, expiry_time.timestamp())
             except ValueError as e:
                 print(f"Timestamp parse error at row {i}: {e}")
                 continue
@@ -141,168 +179,329 @@ def check_existing_tickets(service):
             
             print(f"Cleared expired ticket at row {row}, kept ID: {id_to_keep}")
 
+    except CircuitOpenError:
+        raise
     except Exception as e:
         print(f"Error checking existing tickets: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ticket check error: {str(e)}")
 
+def rebuild_expiry_queue(service):
+    # Hàng đợi có thể còn dòng cũ (leader trước chết giữa chừng) hoặc thiếu dòng: dựng lại từ sheet.
+    # Xóa trước rồi mới quét, để ticket thêm trong lúc quét (ghi sheet trước, đẩy hàng đợi sau) không bị mất
+    ticket_state.clear_queue()
+    check_existing_tickets(service)
+
+def clear_expired_tickets(rebuild_queue):
+    """Một vòng dọn ticket của leader (gọi qua asyncio.to_thread: mọi lệnh Sheets ở đây đều chặn)"""
+    service = init_google_sheets()
+    if rebuild_queue:
+        rebuild_expiry_queue(service)
+    # Phát lại lệnh ghi xếp hàng lúc Sheets lỗi, chỉ khi breaker cho phép thử lại
+    if len(service.outbox) and service.breaker.retry_in() == 0:
+        service.replay_outbox()
+    now = datetime.now(vietnam_tz)
+    pending_rows = sorted(ticket_state.pop_expired(now.timestamp()), reverse=True)
+
+    try:
+        while pending_rows:
+            row = pending_rows[0]
+            result = service.spreadsheets().values().get(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{SHEET_NAME}!A{row}:A{row}"
+            ).execute()
+            id_to_keep = result.get('values', [[""]])[0][0]
+            
+            service.spreadsheets().values().update(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{SHEET_NAME}!A{row}:D{row}",
+                valueInputOption="USER_ENTERED",
+                body={"values": [[id_to_keep, "", "", ""]]}
+            ).execute()
+            pending_rows.pop(0)
+            
+            print(f"Auto-cleared expired ticket at row {row}")
+    finally:
+        # Dòng chưa dọn được (Sheets lỗi giữa chừng) quay lại hàng đợi cho vòng sau
+        for row in pending_rows:
+            ticket_state.push_expiry(row, now.timestamp())
+
 async def cleanup_expired_tickets():
-    global ticket_queue
+    failures = 0
+    queue_rebuilt = False
     while True:
+        delay = 10
         try:
-            service = init_google_sheets()
-            now = datetime.now(vietnam_tz)
-            expired_rows = []
+            # Chỉ worker đang giữ quyền leader mới dọn ticket hết hạn
+            if not await asyncio.to_thread(ticket_state.acquire_leader, "ticket-cleanup", WORKER_ID, LEADER_TTL):
+                queue_rebuilt = False
+                await asyncio.sleep(10)
+                continue
+            # Lần đầu giành được quyền leader (lúc khởi động hoặc khi leader cũ mất lease) thì dựng lại hàng đợi
+            await asyncio.to_thread(clear_expired_tickets, not queue_rebuilt)
+            queue_rebuilt = True
+            failures = 0
+        except Exception as e:
+            failures += 1
+            # Lùi dần khi lỗi liên tiếp nhưng vẫn gia hạn quyền leader trước khi hết TTL
+            delay = min(LEADER_TTL - 5, 10 * 2 ** failures)
+            print(f"Cleanup error: {str(e)}")
+        await asyncio.sleep(delay)
 
-            while ticket_queue:
-                row, expiry = ticket_queue[0]
-                if now >= expiry:
-                    expired_rows.append(row)
-                    ticket_queue.popleft()
-                else:
-                    break
+def initialize_sheets_state():
+    service = init_google_sheets()
+    ensure_headers_and_format(service)
+    # Quét hàng đợi hết hạn do cleanup_expired_tickets làm khi giành quyền leader; ở đây mỗi worker
+    # chỉ đọc một lần để có bản sao cục bộ dùng khi Sheets bị ngắt mạch
+    service.spreadsheets().values().get(
+        spreadsheetId=SPREADSHEET_ID, range=f"{SHEET_NAME}!A2:D", majorDimension="ROWS"
+    ).execute()
+    readiness["sheets"] = True
 
-            if expired_rows:
-                for row in sorted(expired_rows, reverse=True):
-                    result = service.spreadsheets().values().get(
-                        spreadsheetId=SPREADSHEET_ID,
-                        range=f"{SHEET_NAME}!A{row}:A{row}"
-                    ).execute()
-                    id_to_keep = result.get('values', [[""]])[0][0]
-                    
-                    service.spreadsheets().values().update(
-                        spreadsheetId=SPREADSHEET_ID,
-                        range=f"{SHEET_NAME}!A{row}:D{row}",
-                        valueInputOption="USER_ENTERED",
-                        body={"values": [[id_to_keep, "", "", ""]]}
-                    ).execute()
-                    
-                    print(f"Auto-cleared expired ticket at row {row}")
+def warm_up_solver():
+    from autocaptchavip import warm_up
+    stats = warm_up(gap_image_folder="gap_image", json_path="captcha.json", gap_pack_path=GAP_PACK_PATH)
+    readiness["solver"] = True
+    print(f"Solver warm-up done: {stats}")
 
-            await asyncio.sleep(10)
+def feature_cache_stats():
+    # Chưa có solve nào thì cache chưa tồn tại: không import ở đây để /status không kéo numpy vào event loop
+    if "feature_cache" not in sys.modules:
+        return None
+    from feature_cache import get_feature_cache
+    return get_feature_cache().stats()
+
+async def background_initialize():
+    for name, step in (("solver", warm_up_solver), ("sheets", initialize_sheets_state)):
+        try:
+            await asyncio.to_thread(step)
         except Exception as e:
-            print(f"Cleanup error: {str(e)}")
-            await asyncio.sleep(10)
+            readiness["errors"][name] = str(getattr(e, "detail", e))
+            print(f"Background init error ({name}): {readiness['errors'][name]}")
+    asyncio.create_task(cleanup_expired_tickets())
+
 # giải captcha
-@app.post("/api/verify-captcha")
-async def verify_captcha(body: dict = Body(...)):
+RESULT_FIELDS = ["position", "best_confidence", "best_gap_image", "gap_url",
+                 "result_image", "nearest_puzzle_left", "nearest_slider_left",
+                 "subpixel_position", "confidence_margin", "calibrated_slider_left", "match_scale"]
+
+# Giống PuzzleCaptchaSolver.MATCH_MODES; kiểm tra ở đây để trả 400 rõ ràng mà không phải import solver
+MATCH_MODES = ("single", "multiscale")
+
+def solver_options(body):
+    match_mode = body.get("match_mode", "single")
+    if match_mode not in MATCH_MODES:
+        raise HTTPException(400, f"Invalid match_mode: {match_mode!r} (expected one of: {', '.join(MATCH_MODES)})")
+    return {
+        "output_image_path": body.get("output_image_path", "result/result.png"),
+        "gap_image_folder": body.get("gap_image_folder", "gap_image"),
+        "json_path": body.get("json_path", "captcha.json"),
+        "gap_pack_path": body.get("gap_pack_path", GAP_PACK_PATH),
+        "match_mode": match_mode
+    }
+
+def decode_base64_image(value):
+    # null / số / object từ client là lỗi dữ liệu đầu vào (400), không phải lỗi server
+    if not isinstance(value, str):
+        raise ValueError(f"expected a base64 string, got {type(value).__name__}")
+    # Chấp nhận cả data URL: "data:image/png;base64,...."
+    if value.startswith("data:"):
+        value = value.split(",", 1)[1]
+    return base64.b64decode(value, validate=True)
+
+def run_solver(build_solver, profile=False):
+    """Build the solver via build_solver(PuzzleCaptchaSolver), run it and format the API response."""
+    from autocaptchavip import PuzzleCaptchaSolver
     try:
-        solver = PuzzleCaptchaSolver(
-            gap_image_url=body["gap_image_url"],
-            bg_image_url=body["bg_image_url"],
-            output_image_path=body.get("output_image_path", "result/result.png"),
-            gap_image_folder=body.get("gap_image_folder", "gap_image"),
-            json_path=body.get("json_path", "captcha.json")
-        )
-        result = solver.discern()
+        solver = build_solver(PuzzleCaptchaSolver)
+        result = solver.discern(profiler=solve_profiler if profile else None)
         
         if result["position"] is None:
             raise HTTPException(400, "Failed to solve captcha")
             
-        return {
+        response = {
             "status": True,
             "message": "Success",
-            "result": {k: result[k] for k in ["position", "best_confidence", "best_gap_image",
-                                            "gap_url", "result_image", "nearest_puzzle_left",
-                                            "nearest_slider_left"]}
+            "result": {k: result[k] for k in RESULT_FIELDS}
         }
+        if solver.profile_id:
+            response["profile_id"] = solver.profile_id
+        return response
+    except HTTPException:
+        raise
     except FileNotFoundError as e:
         raise HTTPException(404, f"File not found: {e}")
     except KeyError as e:
         raise HTTPException(400, f"Missing required field: {e}")
+    except ValueError as e:
+        raise HTTPException(400, f"Invalid image data: {e}")
     except Exception as e:
         raise HTTPException(500, f"Error")
+
+async def solve_from_urls(body, profile_header=None):
+    # Các request trùng (gap URL, background URL, tuỳ chọn) đang chạy đồng thời dùng chung một lần giải;
+    # request được profile chạy riêng để dump phản ánh đúng lần giải của nó
+    profile = solve_profiler.should_profile(profile_requested(profile_header))
+    try:
+        key = ("urls", body["gap_image_url"], body["bg_image_url"], json.dumps(solver_options(body), sort_keys=True), profile)
+    except KeyError as e:
+        raise HTTPException(400, f"Missing required field: {e}")
+    return await solve_flight.run(key, run_solver, lambda solver_cls: solver_cls(
+        gap_image_url=body["gap_image_url"],
+        bg_image_url=body["bg_image_url"],
+        **solver_options(body)
+    ), profile)
+
+async def solve_from_bytes(gap_bytes, bg_bytes, body, profile_header=None):
+    profile = solve_profiler.should_profile(profile_requested(profile_header))
+    key = ("bytes", hashlib.sha1(gap_bytes).hexdigest(), hashlib.sha1(bg_bytes).hexdigest(),
+           json.dumps(solver_options(body), sort_keys=True), profile)
+    return await solve_flight.run(key, run_solver, lambda solver_cls: solver_cls.from_bytes(
+        gap_bytes, bg_bytes, **solver_options(body)
+    ), profile)
+
+@app.post("/api/verify-captcha")
+async def verify_captcha(body: dict = Body(...), x_profile_solve: str = Header(None)):
+    return await solve_from_urls(body, x_profile_solve)
+
+@app.post("/api/verify-captcha/upload")
+async def verify_captcha_upload(gap_image: UploadFile = File(...), bg_image: UploadFile = File(...),
+                                match_mode: str = Form("single"), x_profile_solve: str = Header(None)):
+    gap_bytes = await gap_image.read()
+    bg_bytes = await bg_image.read()
+    return await solve_from_bytes(gap_bytes, bg_bytes, {"match_mode": match_mode}, x_profile_solve)
+
+@app.post("/api/verify-captcha/base64")
+async def verify_captcha_base64(body: dict = Body(...), x_profile_solve: str = Header(None)):
+    try:
+        gap_bytes = decode_base64_image(body["gap_image"])
+        bg_bytes = decode_base64_image(body["bg_image"])
+    except KeyError as e:
+        raise HTTPException(400, f"Missing required field: {e}")
+    except ValueError as e:
+        raise HTTPException(400, f"Invalid image data: {e}")
+    return await solve_from_bytes(gap_bytes, bg_bytes, body, x_profile_solve)
+
+# Job API: gửi nhiều captcha trên một kết nối rồi lấy kết quả theo lô
+@app.post("/api/jobs")
+async def submit_jobs(body: dict = Body(...)):
+    items = body.get("jobs", [body])
+    if not isinstance(items, list) or not items:
+        raise HTTPException(400, "jobs must be a non-empty list")
+    job_ids = [await solve_jobs.submit(solve_from_urls(item)) for item in items]
+    return {"status": True, "job_ids": job_ids}
+
+@app.get("/api/jobs")
+async def get_jobs(ids: str):
+    jobs = {}
+    for job_id in filter(None, (i.strip() for i in ids.split(","))):
+        jobs[job_id] = await solve_jobs.get(job_id) or {"job_id": job_id, "status": "unknown"}
+    return {"status": True, "jobs": jobs}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await solve_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, f"Job {job_id} not found")
+    return job
+
 ### API Endpoints ###
+# Endpoint ticket gọi Sheets đồng bộ nên để dạng def: FastAPI chạy trong threadpool, không chặn event loop
 @app.post("/api/add-ticket")
-async def add_ticket(ticket: str = Form(...)):
-    global ticket_queue
+def add_ticket(ticket: str = Form(...)):
     try:
         service = init_google_sheets()
-        ensure_headers_and_format(service)
+        # Giữ khóa Sheets từ lúc đọc tới lúc ghi để hai request cùng lúc không chọn trùng một dòng trống
+        with service.lock:
+            ensure_headers_and_format(service)
         
-        now = datetime.now(vietnam_tz)
-        expiry = now + timedelta(minutes=5)
-        timestamp = now.strftime(TIME_FORMAT)
+            now = datetime.now(vietnam_tz)
+            expiry = now + timedelta(minutes=5)
+            timestamp = now.strftime(TIME_FORMAT)
         
-        # Lấy dữ liệu hiện tại từ sheet (chỉ cột B trở đi)
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{SHEET_NAME}!B2:D",
-            majorDimension="ROWS"
-        ).execute()
+            # Lấy dữ liệu hiện tại từ sheet (chỉ cột B trở đi)
+            result = service.spreadsheets().values().get(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{SHEET_NAME}!B2:D",
+                majorDimension="ROWS"
+            ).execute()
         
-        rows = result.get('values', [])
+            rows = result.get('values', [])
         
-        # Tìm ô trống đầu tiên trong cột B
-        target_row = None
-        for i, row in enumerate(rows, start=2):
-            if len(row) == 0 or not row[0].strip():  # Nếu ô B trống
-                target_row = i
-                break
+            # Tìm ô trống đầu tiên trong cột B
+            target_row = None
+            for i, row in enumerate(rows, start=2):
+                if len(row) == 0 or not row[0].strip():  # Nếu ô B trống
+                    target_row = i
+                    break
         
-        # Nếu không tìm thấy ô trống trong dữ liệu hiện có, thêm vào hàng tiếp theo
-        if target_row is None:
-            target_row = len(rows) + 2
+            # Nếu không tìm thấy ô trống trong dữ liệu hiện có, thêm vào hàng tiếp theo
+            if target_row is None:
+                target_row = len(rows) + 2
         
-        # Ghi ticket mới vào ô B của hàng target_row
-        values = [[ticket, "Mới", timestamp]]
-        service.spreadsheets().values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{SHEET_NAME}!B{target_row}:D{target_row}",  # Chỉ ghi từ B đến D
-            valueInputOption="USER_ENTERED",
-            body={"values": values}
-        ).execute()
+            # Ghi ticket mới vào ô B của hàng target_row
+            values = [[ticket, "Mới", timestamp]]
+            service.spreadsheets().values().update(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f"{SHEET_NAME}!B{target_row}:D{target_row}",  # Chỉ ghi từ B đến D
+                valueInputOption="USER_ENTERED",
+                body={"values": values}
+            ).execute()
         
-        # Cập nhật ticket_queue
-        ticket_queue.append((target_row, expiry))
+            # Cập nhật hàng đợi hết hạn
+            ticket_state.push_expiry(target_row, expiry.timestamp())
         
-        return {
-            "status": True,
-            "message": f"Đã thêm ticket vào ô B{target_row}"
-        }
+            return {
+                "status": True,
+                "message": f"Đã thêm ticket vào ô B{target_row}"
+            }
             
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=f"Google Sheets tạm thời không khả dụng: {str(e)}")
     except Exception as e:
         print(f"Lỗi khi thêm ticket: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Lỗi thêm ticket: {str(e)}")
 
 @app.get("/api/delete-ticket")
-async def delete_ticket(ticket: str):
-    global ticket_queue
+def delete_ticket(ticket: str):
     try:
         service = init_google_sheets()
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{SHEET_NAME}!B2:B",
-            majorDimension="COLUMNS"
-        ).execute()
-        
-        tickets = result.get('values', [[]])[0]
-        
-        try:
-            row_number = tickets.index(ticket.strip()) + 2
-            id_result = service.spreadsheets().values().get(
+        with service.lock:
+            result = service.spreadsheets().values().get(
                 spreadsheetId=SPREADSHEET_ID,
-                range=f"{SHEET_NAME}!A{row_number}:A{row_number}"
+                range=f"{SHEET_NAME}!B2:B",
+                majorDimension="COLUMNS"
             ).execute()
-            id_to_keep = id_result.get('values', [[""]])[0][0]
+        
+            tickets = result.get('values', [[]])[0]
+        
+            try:
+                row_number = tickets.index(ticket.strip()) + 2
+                id_result = service.spreadsheets().values().get(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f"{SHEET_NAME}!A{row_number}:A{row_number}"
+                ).execute()
+                id_to_keep = id_result.get('values', [[""]])[0][0]
             
-            service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{SHEET_NAME}!A{row_number}:D{row_number}",
-                valueInputOption="USER_ENTERED",
-                body={"values": [[id_to_keep, "", "", ""]]}
-            ).execute()
+                service.spreadsheets().values().update(
+                    spreadsheetId=SPREADSHEET_ID,
+                    range=f"{SHEET_NAME}!A{row_number}:D{row_number}",
+                    valueInputOption="USER_ENTERED",
+                    body={"values": [[id_to_keep, "", "", ""]]}
+                ).execute()
             
-            ticket_queue = deque([(r, e) for r, e in ticket_queue if r != row_number])
-            return {"status": True, "message": f"Ticket {ticket} deleted"}
+                ticket_state.remove_row(row_number)
+                return {"status": True, "message": f"Ticket {ticket} deleted"}
             
-        except ValueError:
-            return {"status": False, "message": f"Ticket {ticket} not found"}
+            except ValueError:
+                return {"status": False, "message": f"Ticket {ticket} not found"}
             
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=f"Google Sheets temporarily unavailable: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Deletion error: {str(e)}")
 
 @app.get("/api/latest-ticket/{id_profile}")
-async def get_latest_ticket_by_id(id_profile: str):
+def get_latest_ticket_by_id(id_profile: str):
     try:
         service = init_google_sheets()
         result = service.spreadsheets().values().get(
@@ -342,6 +541,8 @@ async def get_latest_ticket_by_id(id_profile: str):
             
         return {"status": True, "ticket": latest_ticket}
         
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=f"Google Sheets temporarily unavailable: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lookup error: {str(e)}")
 
@@ -350,15 +551,37 @@ async def check_status():
     return {
         "status": "online",
         "spreadsheet_id": SPREADSHEET_ID,
-        "timestamp": datetime.now(vietnam_tz).strftime(TIME_FORMAT)
+        "timestamp": datetime.now(vietnam_tz).strftime(TIME_FORMAT),
+        "worker_id": WORKER_ID,
+        "queued_tickets": ticket_state.queue_size(),
+        "solve_coalescing": solve_flight.stats(),
+        "solve_jobs": solve_jobs.stats(),
+        "feature_cache": feature_cache_stats(),
+        "sheets": sheets_guard.stats() if sheets_guard is not None else None
     }
 
+@app.get("/ready")
+async def check_ready():
+    ready = readiness["sheets"] and readiness["solver"]
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "startup_mode": STARTUP_MODE,
+            "sheets": readiness["sheets"],
+            "solver": readiness["solver"],
+            "errors": readiness["errors"]
+        }
+    )
+
 ### Startup ###
 @app.on_event("startup")
 async def on_startup():
-    service = init_google_sheets()
-    ensure_headers_and_format(service)
-    check_existing_tickets(service)
+    if STARTUP_MODE == "lazy":
+        asyncio.create_task(background_initialize())
+        return
+    initialize_sheets_state()
+    warm_up_solver()
     asyncio.create_task(cleanup_expired_tickets())
 
 if __name__ == "__main__":
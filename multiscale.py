@@ -0,0 +1,194 @@
+"""
+Khớp template nhiều tỉ lệ (và tùy chọn nhiều góc xoay) theo kiểu thô -> tinh.
+
+Mỗi template gap được dựng sẵn một "kim tự tháp" các biến thể (tỉ lệ x góc) ở độ
+phân giải đầy đủ và độ phân giải thô (chia coarse_factor), giữ lại giữa các lần giải.
+Khi khớp:
+  1. Bước thô: khớp ảnh nền thu nhỏ với biến thể thô của một nửa số tỉ lệ (xen kẽ)
+  2. Cắt tỉa: chỉ giữ top_k ứng viên (template, biến thể, vị trí) tốt nhất
+  3. Bước tinh: với mỗi ứng viên, khớp các tỉ lệ/góc lân cận ở độ phân giải đầy đủ
+     nhưng chỉ trong cửa sổ nhỏ quanh vị trí tìm được ở bước thô
+
+Edge map có 3 kênh bằng nhau nên khớp trên ảnh xám một kênh cho cùng điểm
+TM_CCOEFF_NORMED mà rẻ hơn 3 lần.
+"""
+import heapq
+import threading
+from collections import OrderedDict
+
+import cv2
+
+from gap_pack import template_hash
+
+DEFAULT_SCALES = (0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.15, 1.3, 1.5, 1.75, 2.0)
+DEFAULT_ANGLES = (0,)
+# Template nhỏ hơn mức này ở bước thô cho điểm tương quan không đáng tin
+MIN_COARSE_SIZE = 6
+
+
+def to_gray(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def transform_template(gray, scale, angle=0):
+    """Template xám sau khi đổi tỉ lệ và xoay quanh tâm (khung được nới để không mất góc)."""
+    height, width = gray.shape[:2]
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    image = cv2.resize(gray, size, interpolation=interpolation)
+    if not angle:
+        return image
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width, new_height = int(round(height * sin + width * cos)), int(round(height * cos + width * sin))
+    matrix[0, 2] += (new_width - width) / 2
+    matrix[1, 2] += (new_height - height) / 2
+    return cv2.warpAffine(image, matrix, (new_width, new_height), flags=cv2.INTER_LINEAR, borderValue=0)
+
+
+class TemplatePyramid:
+    """Các biến thể (tỉ lệ, góc) của một template ở độ phân giải đầy đủ và độ phân giải thô."""
+
+    def __init__(self, template, scales, angles, coarse_factor):
+        gray = to_gray(template)
+        self.scales = scales
+        self.angles = angles
+        self.variants = {}
+        for scale_index, scale in enumerate(scales):
+            for angle_index, angle in enumerate(angles):
+                full = transform_template(gray, scale, angle)
+                height, width = full.shape[:2]
+                coarse_size = (width // coarse_factor, height // coarse_factor)
+                coarse = None
+                if min(coarse_size) >= MIN_COARSE_SIZE:
+                    coarse = cv2.resize(full, coarse_size, interpolation=cv2.INTER_AREA)
+                self.variants[scale_index, angle_index] = (full, coarse)
+
+    def neighbours(self, scale_index, angle_index):
+        for si in (scale_index - 1, scale_index, scale_index + 1):
+            for ai in (angle_index - 1, angle_index, angle_index + 1):
+                if 0 <= si < len(self.scales) and 0 <= ai < len(self.angles):
+                    yield si, ai
+
+
+_pyramids = OrderedDict()
+_pyramids_lock = threading.Lock()
+MAX_PYRAMIDS = 2048
+
+
+def get_pyramid(template, scales, angles, coarse_factor):
+    """Kim tự tháp của template, dựng một lần rồi giữ lại (khóa theo hash nội dung)."""
+    key = (template_hash(template), scales, angles, coarse_factor)
+    with _pyramids_lock:
+        pyramid = _pyramids.get(key)
+        if pyramid is not None:
+            _pyramids.move_to_end(key)
+            return pyramid
+    pyramid = TemplatePyramid(template, scales, angles, coarse_factor)
+    with _pyramids_lock:
+        _pyramids[key] = pyramid
+        while len(_pyramids) > MAX_PYRAMIDS:
+            _pyramids.popitem(last=False)
+    return pyramid
+
+
+class MultiScaleMatcher:
+    def __init__(self, scales=DEFAULT_SCALES, angles=DEFAULT_ANGLES, coarse_factor=2, top_k=3, window=2):
+        self.scales = tuple(sorted(scales))
+        self.angles = tuple(sorted(angles))
+        self.coarse_factor = coarse_factor
+        self.top_k = top_k
+        self.window = window
+        # Bước thô chỉ dùng các tỉ lệ xen kẽ (luôn có tỉ lệ gần 1 nhất); bước tinh bù các tỉ lệ lân cận
+        nearest_one = min(range(len(self.scales)), key=lambda i: abs(self.scales[i] - 1))
+        self.coarse_scale_indexes = {i for i in range(len(self.scales)) if (i - nearest_one) % 2 == 0}
+        self.coarse_matches = 0
+        self.fine_matches = 0
+
+    def match(self, background, templates):
+        """
+        Tìm template + biến thể khớp tốt nhất
+        Parameters:
+            background: Edge map ảnh nền (xám hoặc 3 kênh)
+            templates: Iterable các cặp (tên, ảnh template)
+        Returns:
+            dict {name, template (biến thể xám ở độ phân giải đầy đủ), scale, angle,
+            confidence, location} hoặc None nếu không template nào khớp được
+        """
+        background = to_gray(background)
+        bg_height, bg_width = background.shape[:2]
+        coarse_bg = cv2.resize(background, (bg_width // self.coarse_factor, bg_height // self.coarse_factor),
+                               interpolation=cv2.INTER_AREA)
+
+        candidates = []
+        for name, image in templates:
+            pyramid = get_pyramid(image, self.scales, self.angles, self.coarse_factor)
+            for (scale_index, angle_index), (_, coarse) in pyramid.variants.items():
+                if scale_index not in self.coarse_scale_indexes or coarse is None:
+                    continue
+                if coarse.shape[0] > coarse_bg.shape[0] or coarse.shape[1] > coarse_bg.shape[1]:
+                    continue
+                result = cv2.matchTemplate(coarse_bg, coarse, cv2.TM_CCOEFF_NORMED)
+                self.coarse_matches += 1
+                _, max_val, _, max_loc = cv2.minMaxLoc(result)
+                candidates.append((max_val, len(candidates), name, pyramid, scale_index, angle_index, max_loc))
+
+        best = None
+        seen = set()
+        for _, _, name, pyramid, scale_index, angle_index, coarse_loc in heapq.nlargest(self.top_k, candidates):
+            center_x = coarse_loc[0] * self.coarse_factor
+            center_y = coarse_loc[1] * self.coarse_factor
+            coarse_full = pyramid.variants[scale_index, angle_index][0]
+            for si, ai in pyramid.neighbours(scale_index, angle_index):
+                template = pyramid.variants[si, ai][0]
+                height, width = template.shape[:2]
+                if height > bg_height or width > bg_width:
+                    continue
+                # Cửa sổ quanh vị trí thô; biến thể lân cận lệch tâm so với biến thể thô nên nới thêm
+                pad_x = self.window * self.coarse_factor + abs(width - coarse_full.shape[1]) // 2
+                pad_y = self.window * self.coarse_factor + abs(height - coarse_full.shape[0]) // 2
+                x0 = max(0, min(center_x - pad_x, bg_width - width))
+                y0 = max(0, min(center_y - pad_y, bg_height - height))
+                x1 = min(bg_width, center_x + pad_x + width)
+                y1 = min(bg_height, center_y + pad_y + height)
+                if (id(pyramid), si, ai, x0, y0, x1, y1) in seen:
+                    continue
+                seen.add((id(pyramid), si, ai, x0, y0, x1, y1))
+                result = cv2.matchTemplate(background[y0:y1, x0:x1], template, cv2.TM_CCOEFF_NORMED)
+                self.fine_matches += 1
+                _, max_val, _, max_loc = cv2.minMaxLoc(result)
+                if best is None or max_val > best["confidence"]:
+                    best = {
+                        "name": name,
+                        "template": template,
+                        "scale": pyramid.scales[si],
+                        "angle": pyramid.angles[ai],
+                        "confidence": float(max_val),
+                        "location": (x0 + max_loc[0], y0 + max_loc[1]),
+                    }
+        return best
+
+    def stats(self):
+        return {"coarse_matches": self.coarse_matches, "fine_matches": self.fine_matches}
+
+
+def naive_match(background, templates, scales=DEFAULT_SCALES, angles=DEFAULT_ANGLES):
+    """Khớp vét cạn mọi template ở mọi tỉ lệ/góc trên toàn ảnh (dùng làm mốc so sánh)."""
+    background = to_gray(background)
+    best = None
+    for name, image in templates:
+        gray = to_gray(image)
+        for scale in scales:
+            for angle in angles:
+                template = transform_template(gray, scale, angle)
+                if template.shape[0] > background.shape[0] or template.shape[1] > background.shape[1]:
+                    continue
+                result = cv2.matchTemplate(background, template, cv2.TM_CCOEFF_NORMED)
+                _, max_val, _, max_loc = cv2.minMaxLoc(result)
+                if best is None or max_val > best["confidence"]:
+                    best = {"name": name, "template": template, "scale": scale, "angle": angle,
+                            "confidence": float(max_val), "location": max_loc}
+    return best
@@ -0,0 +1,313 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class RedisStateBackend:
+    """
+    Trạng thái ticket dùng chung giữa các worker, lưu trên Redis (hoặc client bất kỳ
+    có cùng giao diện lệnh, ví dụ LocalRedis bên dưới).
+
+    - Hàng đợi hết hạn: sorted set {dòng: thời điểm hết hạn (epoch giây)}
+    - Cache dòng sheet: list các dòng dạng JSON
+    - Leader: key có TTL, chỉ worker giữ key mới chạy vòng dọn ticket
+    - Job API: mỗi job một key JSON có TTL, để worker bất kỳ trả lời được khi client poll
+    """
+
+    def __init__(self, client, prefix="tickets:"):
+        self.client = client
+        self.queue_key = prefix + "queue"
+        self.cache_key = prefix + "cache"
+        self.leader_prefix = prefix + "leader:"
+        self.job_prefix = prefix + "job:"
+        # LocalRedis chỉ sống trong một tiến trình (và chỉ hết hạn key khi được đọc lại)
+        self.shared = not isinstance(client, LocalRedis)
+
+    def push_expiry(self, row, expiry_ts):
+        self.client.zadd(self.queue_key, {str(row): expiry_ts})
+
+    def pop_expired(self, now_ts):
+        rows = [_text(r) for r in self.client.zrangebyscore(self.queue_key, "-inf", now_ts)]
+        if rows:
+            self.client.zrem(self.queue_key, *rows)
+        return [int(r) for r in rows]
+
+    def remove_row(self, row):
+        self.client.zrem(self.queue_key, str(row))
+
+    def queue_size(self):
+        return self.client.zcard(self.queue_key)
+
+    def clear_queue(self):
+        self.client.delete(self.queue_key)
+
+    def get_cache(self):
+        return [json.loads(_text(r)) for r in self.client.lrange(self.cache_key, 0, -1)]
+
+    def set_cache(self, rows):
+        self.client.delete(self.cache_key)
+        if rows:
+            self.client.rpush(self.cache_key, *(json.dumps(r, ensure_ascii=False) for r in rows))
+
+    def append_cache(self, row):
+        return self.client.rpush(self.cache_key, json.dumps(row, ensure_ascii=False))
+
+    def pop_cache(self, index):
+        # Redis không có lệnh xóa theo vị trí: ghi đè bằng giá trị đánh dấu rồi LREM
+        marker = f"__deleted__:{os.getpid()}:{threading.get_ident()}:{time.time()}"
+        try:
+            self.client.lset(self.cache_key, index, marker)
+        except Exception:
+            return False
+        self.client.lrem(self.cache_key, 1, marker)
+        return True
+
+    def cache_size(self):
+        return self.client.llen(self.cache_key)
+
+    def acquire_leader(self, name, owner, ttl):
+        key = self.leader_prefix + name
+        ttl_ms = int(ttl * 1000)
+        if self.client.set(key, owner, nx=True, px=ttl_ms):
+            return True
+        if _text(self.client.get(key)) == owner:
+            self.client.pexpire(key, ttl_ms)
+            return True
+        return False
+
+    def put_job(self, job_id, job, ttl):
+        self.client.set(self.job_prefix + job_id, json.dumps(job, ensure_ascii=False), px=int(ttl * 1000))
+
+    def get_job(self, job_id):
+        value = self.client.get(self.job_prefix + job_id)
+        return json.loads(_text(value)) if value is not None else None
+
+
+class LocalRedis:
+    """
+    Bản thay thế Redis chạy trong tiến trình, chỉ cài các lệnh RedisStateBackend dùng.
+    Dùng làm backend mặc định (một worker) và để kiểm thử không cần server Redis.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}
+        self._expires = {}
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and time.monotonic() >= expires:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, nx=False, px=None):
+        with self._lock:
+            if nx and self._alive(key):
+                return None
+            self._data[key] = value
+            self._expires.pop(key, None)
+            if px is not None:
+                self._expires[key] = time.monotonic() + px / 1000
+            return True
+
+    def pexpire(self, key, px):
+        with self._lock:
+            if not self._alive(key):
+                return 0
+            self._expires[key] = time.monotonic() + px / 1000
+            return 1
+
+    def delete(self, *keys):
+        with self._lock:
+            removed = 0
+            for key in keys:
+                if self._alive(key):
+                    del self._data[key]
+                    self._expires.pop(key, None)
+                    removed += 1
+            return removed
+
+    def zadd(self, key, mapping):
+        with self._lock:
+            zset = self._data.setdefault(key, {})
+            added = sum(1 for member in mapping if member not in zset)
+            zset.update({member: float(score) for member, score in mapping.items()})
+            return added
+
+    def zrangebyscore(self, key, min_score, max_score):
+        with self._lock:
+            low, high = float(min_score), float(max_score)
+            items = sorted(self._data.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+            return [member for member, score in items if low <= score <= high]
+
+    def zrem(self, key, *members):
+        with self._lock:
+            zset = self._data.get(key, {})
+            return sum(1 for member in members if zset.pop(member, None) is not None)
+
+    def zcard(self, key):
+        with self._lock:
+            return len(self._data.get(key, {}))
+
+    def rpush(self, key, *values):
+        with self._lock:
+            items = self._data.setdefault(key, [])
+            items.extend(values)
+            return len(items)
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            items = self._data.get(key, [])
+            end = len(items) if end == -1 else end + 1
+            return list(items[start:end])
+
+    def lset(self, key, index, value):
+        with self._lock:
+            items = self._data.get(key)
+            if items is None or not -len(items) <= index < len(items):
+                raise IndexError("index out of range")
+            items[index] = value
+            return True
+
+    def lrem(self, key, count, value):
+        with self._lock:
+            items = self._data.get(key, [])
+            indexes = [i for i, item in enumerate(items) if item == value]
+            if count > 0:
+                indexes = indexes[:count]
+            elif count < 0:
+                indexes = indexes[count:]
+            for i in reversed(indexes):
+                del items[i]
+            return len(indexes)
+
+    def llen(self, key):
+        with self._lock:
+            return len(self._data.get(key, []))
+
+
+class SQLiteStateBackend:
+    """
+    Trạng thái ticket dùng chung giữa các worker trên cùng máy, lưu trong SQLite (WAL)
+    để nhiều tiến trình uvicorn đọc/ghi đồng thời.
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS ticket_queue (row INTEGER PRIMARY KEY, expiry REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS ticket_cache (position INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def push_expiry(self, row, expiry_ts):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO ticket_queue (row, expiry) VALUES (?, ?)", (row, expiry_ts))
+
+    def pop_expired(self, now_ts):
+        with self._transaction() as conn:
+            rows = [r for (r,) in conn.execute("SELECT row FROM ticket_queue WHERE expiry <= ? ORDER BY expiry", (now_ts,))]
+            conn.executemany("DELETE FROM ticket_queue WHERE row = ?", [(r,) for r in rows])
+        return rows
+
+    def remove_row(self, row):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM ticket_queue WHERE row = ?", (row,))
+
+    def queue_size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM ticket_queue").fetchone()[0]
+
+    def clear_queue(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM ticket_queue")
+
+    def get_cache(self):
+        return [json.loads(data) for (data,) in self._connect().execute("SELECT data FROM ticket_cache ORDER BY position")]
+
+    def set_cache(self, rows):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM ticket_cache")
+            conn.executemany("INSERT INTO ticket_cache (position, data) VALUES (?, ?)",
+                             [(i, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(rows)])
+
+    def append_cache(self, row):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO ticket_cache (position, data) SELECT COALESCE(MAX(position), -1) + 1, ? FROM ticket_cache",
+                         (json.dumps(row, ensure_ascii=False),))
+            return conn.execute("SELECT COUNT(*) FROM ticket_cache").fetchone()[0]
+
+    def pop_cache(self, index):
+        with self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM ticket_cache WHERE position = "
+                                  "(SELECT position FROM ticket_cache ORDER BY position LIMIT 1 OFFSET ?)", (index,))
+            return cursor.rowcount > 0
+
+    def cache_size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM ticket_cache").fetchone()[0]
+
+    def acquire_leader(self, name, owner, ttl):
+        now = time.time()
+        with self._transaction() as conn:
+            current = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if current is not None and current[0] != owner and current[1] > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)", (name, owner, now + ttl))
+            return True
+
+    def put_job(self, job_id, job, ttl):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE expires_at <= ?", (now,))
+            conn.execute("INSERT OR REPLACE INTO jobs (job_id, data, expires_at) VALUES (?, ?, ?)",
+                         (job_id, json.dumps(job, ensure_ascii=False), now + ttl))
+
+    def get_job(self, job_id):
+        row = self._connect().execute("SELECT data FROM jobs WHERE job_id = ? AND expires_at > ?",
+                                      (job_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def create_state_backend(url=None):
+    """
+    Tạo backend theo URL (mặc định lấy từ biến môi trường STATE_BACKEND_URL):
+        ""                   -> LocalRedis trong tiến trình (chỉ dùng với một worker)
+        sqlite:///state.db   -> SQLite WAL, dùng chung giữa các worker trên một máy
+        redis://host:6379/0  -> Redis (cần cài thư viện redis)
+    """
+    url = os.environ.get("STATE_BACKEND_URL", "") if url is None else url
+    if not url or url == "memory://":
+        return RedisStateBackend(LocalRedis())
+    if url.startswith("sqlite:///"):
+        return SQLiteStateBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        import redis
+        return RedisStateBackend(redis.Redis.from_url(url))
+    raise ValueError(f"STATE_BACKEND_URL không được hỗ trợ: {url}")
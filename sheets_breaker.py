@@ -0,0 +1,457 @@
+"""
+Circuit breaker + chế độ suy giảm cho client Google Sheets.
+
+GuardedSheetsService bọc service của googleapiclient (hoặc FakeSheetsService trong
+loadtest.py) với cùng giao diện service.spreadsheets().values().get(...).execute():
+
+- Mọi execute() đi qua CircuitBreaker: đếm lỗi/độ trễ trong cửa sổ gần nhất, mở mạch
+  khi quá ngưỡng, sau reset_timeout cho một request thử (half-open) rồi đóng lại nếu ổn.
+- Đọc: kết quả thành công được ghi vào SheetMirror (bản sao cục bộ các cột đã đọc);
+  khi mạch mở hoặc Sheets lỗi, đọc từ bản sao nếu bản sao đã đầy đủ.
+- Ghi (update/clear/batchUpdate, đều ghi đè nên phát lại an toàn): khi mạch mở hoặc
+  Sheets lỗi, ghi vào SheetsOutbox (SQLite) và áp lên bản sao; replay_outbox() phát lại
+  theo thứ tự khi Sheets ổn định trở lại.
+"""
+import collections
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Các thao tác ghi đè (idempotent), được xếp hàng khi Sheets không dùng được
+QUEUEABLE_WRITES = ("update", "clear", "batchUpdate")
+
+
+class CircuitOpenError(Exception):
+    """Sheets đang bị ngắt mạch và không có dữ liệu cục bộ để phục vụ request."""
+
+
+def is_transient(error):
+    """Lỗi tạm thời (mạng, timeout, 429, 5xx) mới tính là Sheets không khỏe; lỗi 4xx khác là lỗi của request."""
+    status = getattr(getattr(error, "resp", None), "status", None)
+    if status is None:
+        return True
+    return int(status) == 429 or int(status) >= 500
+
+
+def column_index(letters):
+    index = 0
+    for ch in letters:
+        index = index * 26 + ord(ch) - ord("A") + 1
+    return index - 1
+
+
+def parse_a1(range_str):
+    """'huy1!A2:D' -> (hàng đầu, hàng cuối hoặc None, cột đầu, cột cuối), hàng tính từ 1."""
+    cells = range_str.split("!", 1)[-1]
+    start, _, end = cells.partition(":")
+    end = end or start
+    m_start = re.fullmatch(r"([A-Z]+)(\d*)", start)
+    m_end = re.fullmatch(r"([A-Z]+)(\d*)", end)
+    row_start = int(m_start.group(2)) if m_start.group(2) else 1
+    row_end = int(m_end.group(2)) if m_end.group(2) else None
+    return row_start, row_end, column_index(m_start.group(1)), column_index(m_end.group(1))
+
+
+class CircuitBreaker:
+    """
+    Mở mạch khi trong window lần gọi gần nhất có từ failure_threshold lần lỗi hoặc chậm
+    (lâu hơn slow_call_ms). Mỗi lần mở lại liên tiếp, thời gian chờ nhân đôi tới max_reset_timeout.
+    """
+
+    def __init__(self, failure_threshold=5, window=20, slow_call_ms=3000, reset_timeout=30, max_reset_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.slow_call_ms = slow_call_ms
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = CLOSED
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_error = None
+        self._outcomes = collections.deque(maxlen=window)
+        self._latencies = collections.deque(maxlen=200)
+        self._opened_at = None
+        self._open_timeout = reset_timeout
+        self._probe_running = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """SHEETS_BREAKER_FAILURES, SHEETS_BREAKER_WINDOW, SHEETS_SLOW_CALL_MS, SHEETS_BREAKER_RESET"""
+        return cls(
+            failure_threshold=int(os.environ.get("SHEETS_BREAKER_FAILURES", "5")),
+            window=int(os.environ.get("SHEETS_BREAKER_WINDOW", "20")),
+            slow_call_ms=float(os.environ.get("SHEETS_SLOW_CALL_MS", "3000")),
+            reset_timeout=float(os.environ.get("SHEETS_BREAKER_RESET", "30")),
+        )
+
+    def retry_in(self):
+        """Số giây tới lần được thử lại (0 nếu mạch không mở)."""
+        with self._lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self._open_timeout - time.monotonic())
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self._open_timeout:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probe_running:
+                self._probe_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, latency_ms, error=None):
+        failed = error is not None or latency_ms > self.slow_call_ms
+        with self._lock:
+            self.calls += 1
+            self._latencies.append(latency_ms)
+            self._outcomes.append(failed)
+            if failed:
+                self.failures += 1
+                self.last_error = repr(error) if error is not None else f"slow call: {latency_ms:.0f} ms"
+            if self.state == HALF_OPEN:
+                self._probe_running = False
+                if failed:
+                    self._trip(min(self.max_reset_timeout, self._open_timeout * 2))
+                else:
+                    self.state = CLOSED
+                    self._open_timeout = self.reset_timeout
+                    self._outcomes.clear()
+            elif self.state == CLOSED and sum(self._outcomes) >= self.failure_threshold:
+                self._trip(self.reset_timeout)
+
+    def _trip(self, timeout):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._open_timeout = timeout
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError("Google Sheets đang bị ngắt mạch")
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record((time.perf_counter() - start) * 1000, e if is_transient(e) else None)
+            raise
+        self.record((time.perf_counter() - start) * 1000)
+        return result
+
+    def stats(self):
+        retry_in = self.retry_in()
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "state": self.state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "recent_failure_rate": round(sum(self._outcomes) / len(self._outcomes), 3) if self._outcomes else 0.0,
+                "latency_p50_ms": round(latencies[len(latencies) // 2], 1) if latencies else None,
+                "latency_p95_ms": round(latencies[int(len(latencies) * 0.95)], 1) if latencies else None,
+                "retry_in_s": round(retry_in, 1),
+                "last_error": self.last_error,
+            }
+
+
+class SheetMirror:
+    """
+    Bản sao cục bộ các ô đã đọc/ghi. Chỉ được dùng để trả lời đọc khi đã có một lần
+    đọc trọn các cột cần thiết (ví dụ A2:D) từ hàng đầu dữ liệu trở đi.
+    """
+
+    def __init__(self, columns=4, first_data_row=2):
+        self.columns = columns
+        self.first_data_row = first_data_row
+        self.complete = False
+        self.refreshed_at = None
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def _set(self, row, col, value):
+        if col < self.columns:
+            cells = self._rows.setdefault(row, [""] * self.columns)
+            cells[col] = value
+
+    def store_read(self, range_str, response, major_dimension="ROWS"):
+        row_start, row_end, col_start, col_end = parse_a1(range_str)
+        values = response.get("values", [])
+        if major_dimension == "COLUMNS":
+            height = max((len(column) for column in values), default=0)
+            values = [[column[i] if i < len(column) else "" for column in values] for i in range(height)]
+        with self._lock:
+            last_row = row_end if row_end is not None else max(list(self._rows) + [row_start + len(values) - 1])
+            for row in range(row_start, last_row + 1):
+                cells = values[row - row_start] if row - row_start < len(values) else []
+                for col in range(col_start, col_end + 1):
+                    self._set(row, col, cells[col - col_start] if col - col_start < len(cells) else "")
+            if row_end is None and row_start <= self.first_data_row and col_start == 0 and col_end >= self.columns - 1:
+                self.complete = True
+                self.refreshed_at = time.time()
+
+    def apply_update(self, range_str, values):
+        row_start, _, col_start, _ = parse_a1(range_str)
+        with self._lock:
+            for i, cells in enumerate(values):
+                for j, value in enumerate(cells):
+                    self._set(row_start + i, col_start + j, "" if value is None else str(value))
+
+    def apply_clear(self, range_str):
+        row_start, row_end, col_start, col_end = parse_a1(range_str)
+        with self._lock:
+            rows = [r for r in self._rows if r >= row_start and (row_end is None or r <= row_end)]
+            for row in rows:
+                for col in range(col_start, min(col_end, self.columns - 1) + 1):
+                    self._set(row, col, "")
+
+    def read(self, range_str, major_dimension="ROWS"):
+        """Trả về response giống values().get(), hoặc None nếu bản sao chưa đủ để trả lời."""
+        row_start, row_end, col_start, col_end = parse_a1(range_str)
+        with self._lock:
+            if not self.complete or col_end >= self.columns:
+                return None
+            # Các hàng trước vùng dữ liệu (tiêu đề) chỉ trả lời được nếu đã từng đọc
+            if any(r not in self._rows for r in range(row_start, self.first_data_row)):
+                return None
+            last_row = row_end if row_end is not None else max(self._rows, default=row_start - 1)
+            rows = [_trim([self._rows.get(r, [""] * self.columns)[c] for c in range(col_start, col_end + 1)])
+                    for r in range(row_start, last_row + 1)]
+        if major_dimension == "COLUMNS":
+            rows = [_trim([row[i] if i < len(row) else "" for row in rows]) for i in range(col_end - col_start + 1)]
+        rows = _trim(rows)
+        response = {"range": range_str, "majorDimension": major_dimension, "fromCache": True}
+        if rows:
+            response["values"] = rows
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {"complete": self.complete, "rows": len(self._rows), "refreshed_at": self.refreshed_at}
+
+
+def _trim(values):
+    while values and values[-1] in ("", []):
+        values.pop()
+    return values
+
+
+class SheetsOutbox:
+    """
+    Hàng đợi ghi bền vững (SQLite WAL) cho các lệnh ghi chưa gửi được.
+    Lệnh mới ghi đè cùng vùng (cùng thao tác + range) thay thế lệnh cũ đang chờ của cùng
+    owner (worker). Lệnh của worker khác không bị thay: mỗi worker có SheetMirror riêng nên
+    hai worker có thể cùng chọn một dòng trống, và cả hai lệnh ghi phải được phát lại.
+    """
+
+    def __init__(self, path, owner=None):
+        self.path = path
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "dedupe_key TEXT NOT NULL, path TEXT NOT NULL, kwargs TEXT NOT NULL, created_at REAL NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def push(self, path, kwargs):
+        kwargs_json = json.dumps(kwargs, ensure_ascii=False, sort_keys=True)
+        if path[-1] == "batchUpdate":
+            dedupe_key = "/".join(path) + ":" + kwargs_json
+        else:
+            dedupe_key = "/".join(path) + ":" + str(kwargs.get("range"))
+        dedupe_key = self.owner + "|" + dedupe_key
+        with self._connect() as conn:
+            conn.execute("DELETE FROM outbox WHERE dedupe_key = ?", (dedupe_key,))
+            conn.execute("INSERT INTO outbox (dedupe_key, path, kwargs, created_at) VALUES (?, ?, ?, ?)",
+                         (dedupe_key, json.dumps(path), kwargs_json, time.time()))
+
+    def peek(self):
+        row = self._connect().execute("SELECT id, path, kwargs FROM outbox ORDER BY id LIMIT 1").fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), json.loads(row[2])
+
+    def remove(self, entry_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def oldest_age(self):
+        row = self._connect().execute("SELECT MIN(created_at) FROM outbox").fetchone()
+        return round(time.time() - row[0], 1) if row and row[0] is not None else None
+
+
+class GuardedSheetsService:
+    def __init__(self, service, breaker, mirror, outbox):
+        self.service = service
+        self.breaker = breaker
+        self.mirror = mirror
+        self.outbox = outbox
+        self.served_from_cache = 0
+        self.queued_writes = 0
+        self.replayed_writes = 0
+        self._replay_lock = threading.Lock()
+        # httplib2 không an toàn luồng: mọi lệnh gửi Sheets đi qua khóa này. Caller giữ khóa
+        # khi cần đọc-rồi-ghi nguyên tử (ví dụ chọn dòng trống rồi ghi ticket vào đó)
+        self.lock = threading.RLock()
+
+    def spreadsheets(self):
+        return _GuardedResource(self, self.service.spreadsheets(), ("spreadsheets",))
+
+    @property
+    def degraded(self):
+        return self.breaker.state != CLOSED or len(self.outbox) > 0
+
+    def _build(self, path, kwargs):
+        resource = self.service
+        for name in path[:-1]:
+            resource = getattr(resource, name)()
+        return getattr(resource, path[-1])(**kwargs)
+
+    def _execute(self, path, kwargs, request):
+        op = path[-1]
+        with self.lock:
+            if op == "get":
+                return self._execute_read(kwargs, request)
+            if op in QUEUEABLE_WRITES:
+                return self._execute_write(path, kwargs, request)
+            return self.breaker.call(request.execute)
+
+    def _execute_read(self, kwargs, request):
+        major_dimension = kwargs.get("majorDimension", "ROWS")
+        if len(self.outbox) == 0:
+            try:
+                response = self.breaker.call(request.execute)
+            except Exception as e:
+                # Lỗi 4xx (sai range, thiếu quyền...) là lỗi của request, không che bằng bản sao cục bộ
+                if not is_transient(e):
+                    raise
+                response = None
+            if response is not None:
+                self.mirror.store_read(kwargs["range"], response, major_dimension)
+                return response
+        # Sheets không dùng được, hoặc còn lệnh ghi chưa phát lại khiến sheet thật đang cũ hơn bản sao
+        cached = self.mirror.read(kwargs["range"], major_dimension)
+        if cached is None:
+            if len(self.outbox):
+                return self.breaker.call(request.execute)
+            raise CircuitOpenError(f"Google Sheets không khả dụng và chưa có dữ liệu cục bộ cho {kwargs['range']}")
+        self.served_from_cache += 1
+        return cached
+
+    def _execute_write(self, path, kwargs, request):
+        # Giữ thứ tự: còn lệnh đang chờ thì lệnh mới cũng phải xếp sau
+        if len(self.outbox) == 0:
+            try:
+                response = self.breaker.call(request.execute)
+                self._apply_to_mirror(path[-1], kwargs)
+                return response
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                if not isinstance(e, CircuitOpenError):
+                    print(f"Sheets write failed, queueing for replay: {e}")
+        self.outbox.push(list(path), kwargs)
+        self._apply_to_mirror(path[-1], kwargs)
+        self.queued_writes += 1
+        return {"queued": True, "updatedRange": kwargs.get("range")}
+
+    def _apply_to_mirror(self, op, kwargs):
+        if op == "update":
+            self.mirror.apply_update(kwargs["range"], (kwargs.get("body") or {}).get("values", []))
+        elif op == "clear":
+            self.mirror.apply_clear(kwargs["range"])
+
+    def replay_outbox(self, limit=100):
+        """Phát lại lệnh ghi đang chờ theo thứ tự, dừng ở lỗi đầu tiên. Trả về số lệnh đã gửi."""
+        sent = 0
+        with self._replay_lock:
+            while sent < limit:
+                entry = self.outbox.peek()
+                if entry is None:
+                    break
+                entry_id, path, kwargs = entry
+                try:
+                    with self.lock:
+                        self.breaker.call(self._build(path, kwargs).execute)
+                except Exception as e:
+                    if is_transient(e):
+                        print(f"Sheets replay stopped: {e}")
+                        break
+                    # Lỗi cố định (request sai) thì phát lại bao nhiêu lần cũng vậy: bỏ để không chặn hàng đợi
+                    print(f"Dropping queued Sheets write {'/'.join(path)} {kwargs.get('range')}: {e}")
+                self.outbox.remove(entry_id)
+                sent += 1
+        self.replayed_writes += sent
+        return sent
+
+    def stats(self):
+        return {
+            "mode": "degraded" if self.degraded else "normal",
+            "breaker": self.breaker.stats(),
+            "outbox_pending": len(self.outbox),
+            "outbox_oldest_age_s": self.outbox.oldest_age(),
+            "queued_writes": self.queued_writes,
+            "replayed_writes": self.replayed_writes,
+            "served_from_cache": self.served_from_cache,
+            "mirror": self.mirror.stats(),
+        }
+
+
+class _GuardedResource:
+    def __init__(self, owner, resource, path):
+        self._owner = owner
+        self._resource = resource
+        self._path = path
+
+    def __getattr__(self, name):
+        method = getattr(self._resource, name)
+
+        def call(*args, **kwargs):
+            result = method(*args, **kwargs)
+            path = self._path + (name,)
+            if hasattr(result, "execute"):
+                return _GuardedRequest(self._owner, path, kwargs, result)
+            return _GuardedResource(self._owner, result, path)
+        return call
+
+
+class _GuardedRequest:
+    def __init__(self, owner, path, kwargs, request):
+        self._owner = owner
+        self._path = path
+        self._kwargs = kwargs
+        self._request = request
+
+    def execute(self):
+        return self._owner._execute(self._path, self._kwargs, self._request)
+
+
+def guard_sheets_service(service, breaker=None, outbox_path=None, owner=None):
+    """
+    Bọc service với breaker + bản sao + outbox (outbox_path mặc định từ SHEETS_OUTBOX_PATH).
+    owner: định danh worker, để lệnh ghi của các worker khác nhau không thay thế nhau trong outbox.
+    """
+    outbox_path = outbox_path or os.environ.get("SHEETS_OUTBOX_PATH", "sheets_outbox.db")
+    return GuardedSheetsService(service, breaker or CircuitBreaker.from_env(), SheetMirror(),
+                                SheetsOutbox(outbox_path, owner=owner))
@@ -0,0 +1,116 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi đồng thời có cùng key: request đầu tiên chạy fn trong thread,
+    các request trùng key đến trong lúc đó chờ và nhận chung kết quả (hoặc lỗi).
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def run(self, key, fn, *args):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        self.calls += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await asyncio.to_thread(fn, *args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Đánh dấu đã lấy lỗi để asyncio không cảnh báo khi không có ai chờ
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        return {"in_flight": len(self._inflight), "calls": self.calls, "shared": self.shared}
+
+
+class JobStore:
+    """
+    Hàng đợi job kiểu submit-then-poll: client gửi nhiều job trên cùng một kết nối
+    rồi hỏi kết quả theo lô. Job đã xong được giữ ttl giây, tối đa max_jobs job.
+
+    Job chạy trong worker nhận submit. Với store (backend của shared_state có
+    put_job/get_job) trạng thái và kết quả được ghi ra đó ở mỗi lần đổi trạng thái, nên
+    lần poll rơi vào worker khác vẫn trả lời được; không có store thì chỉ dùng được với
+    một worker.
+    """
+
+    def __init__(self, max_jobs=10000, ttl=600, store=None):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.store = store
+        self._jobs = OrderedDict()
+
+    async def submit(self, coro):
+        self._evict()
+        job_id = uuid.uuid4().hex
+        self._jobs[job_id] = {"job_id": job_id, "status": "pending", "created_at": time.time()}
+        await self._publish(self._jobs[job_id])
+        asyncio.create_task(self._run(job_id, coro))
+        return job_id
+
+    async def _run(self, job_id, coro):
+        job = self._jobs.get(job_id)
+        if job is None:
+            coro.close()
+            return
+        job["status"] = "running"
+        await self._publish(job)
+        try:
+            job["result"] = await coro
+            job["status"] = "done"
+        except Exception as e:
+            job["status"] = "error"
+            job["status_code"] = getattr(e, "status_code", 500)
+            job["error"] = str(getattr(e, "detail", e))
+        job["finished_at"] = time.time()
+        await self._publish(job)
+
+    async def _publish(self, job):
+        if self.store is None:
+            return
+        try:
+            # Backend (SQLite/Redis) có thể chặn nên ghi trong thread
+            await asyncio.to_thread(self.store.put_job, job["job_id"], dict(job), self.ttl)
+        except Exception as e:
+            print(f"Không ghi được job {job['job_id']} ra backend dùng chung: {e}")
+
+    async def get(self, job_id):
+        """Job của worker này, hoặc job do worker khác chạy (qua store); None nếu không có"""
+        job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = await asyncio.to_thread(self.store.get_job, job_id)
+        return job
+
+    def _evict(self):
+        now = time.time()
+        for job_id in [j for j, job in self._jobs.items() if now - job.get("finished_at", now) > self.ttl]:
+            del self._jobs[job_id]
+        while len(self._jobs) >= self.max_jobs:
+            self._jobs.popitem(last=False)
+
+    def stats(self):
+        counts = {}
+        for job in self._jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"jobs": len(self._jobs), **counts}
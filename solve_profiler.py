@@ -0,0 +1,167 @@
+"""
+Profile theo yêu cầu cho PuzzleCaptchaSolver.discern.
+
+Mỗi lần profile ghi hai file vào thư mục dump (giữ tối đa max_dumps lần, xóa cũ nhất trước):
+    <id>.prof  dữ liệu cProfile (đọc bằng pstats / snakeviz / flameprof)
+    <id>.json  thời gian từng bước, hash ảnh đầu vào, kết quả và metadata request
+
+Tổng hợp các dump thành báo cáo hàm nóng:
+    python solve_profiler.py report profiles --top 30 --min-total-ms 500
+"""
+import argparse
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+
+
+def profile_requested(header_value):
+    """Giá trị header X-Profile-Solve có yêu cầu profile hay không ("1", "true", "yes")."""
+    return (header_value or "").strip().lower() in ("1", "true", "yes")
+
+
+class SolveProfiler:
+    def __init__(self, dump_dir="profiles", max_dumps=200, sample_every=0):
+        self.dump_dir = dump_dir
+        self.max_dumps = max_dumps
+        self.sample_every = sample_every
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """PROFILE_DIR, PROFILE_MAX_DUMPS, PROFILE_SAMPLE_EVERY (0 = chỉ profile khi được yêu cầu)"""
+        return cls(
+            dump_dir=os.environ.get("PROFILE_DIR", "profiles"),
+            max_dumps=int(os.environ.get("PROFILE_MAX_DUMPS", "200")),
+            sample_every=int(os.environ.get("PROFILE_SAMPLE_EVERY", "0")),
+        )
+
+    def should_profile(self, requested=False):
+        """Profile khi request yêu cầu (header) hoặc theo lấy mẫu 1/N request."""
+        if requested:
+            return True
+        return self.sample_every > 0 and next(self._counter) % self.sample_every == 0
+
+    def run(self, solver, meta=None):
+        solver.collect_input_hashes = True
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        result = None
+        error = None
+        profile.enable()
+        try:
+            result = solver.discern()
+            return result
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            profile.disable()
+            total_ms = (time.perf_counter() - start) * 1000
+            solver.profile_id = profile_id
+            try:
+                self._write(profile_id, profile, {
+                    "profile_id": profile_id,
+                    "timestamp": time.time(),
+                    "total_ms": round(total_ms, 3),
+                    "stage_timings": solver.stage_timings,
+                    "input_hashes": solver.input_hashes,
+                    "feature_cache_hit": solver.feature_cache_hit,
+                    "gap_url": solver.gap_image_url,
+                    "bg_url": solver.bg_image_url,
+                    "position": result.get("position") if result else None,
+                    "best_confidence": result.get("best_confidence") if result else None,
+                    "error": error,
+                    "meta": meta or {},
+                })
+            except OSError as e:
+                print(f"Không ghi được profile {profile_id}: {e}")
+
+    def _write(self, profile_id, profile, summary):
+        with self._lock:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            profile.dump_stats(os.path.join(self.dump_dir, profile_id + ".prof"))
+            with open(os.path.join(self.dump_dir, profile_id + ".json"), "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            self._rotate()
+
+    def _rotate(self):
+        # id bắt đầu bằng thời gian nên sắp theo tên là sắp theo thời gian
+        ids = sorted(name[:-len(".json")] for name in os.listdir(self.dump_dir) if name.endswith(".json"))
+        for old_id in ids[:max(0, len(ids) - self.max_dumps)]:
+            for ext in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(self.dump_dir, old_id + ext))
+                except FileNotFoundError:
+                    pass
+
+
+def load_summaries(dump_dir, min_total_ms=0):
+    summaries = []
+    for name in sorted(os.listdir(dump_dir)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(dump_dir, name), encoding="utf-8") as f:
+            summary = json.load(f)
+        if summary.get("total_ms", 0) >= min_total_ms:
+            summaries.append(summary)
+    return summaries
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(pct / 100 * len(values))) - 1))]
+
+
+def build_report(dump_dir, top=25, sort="cumulative", min_total_ms=0, slowest=5):
+    summaries = load_summaries(dump_dir, min_total_ms)
+    if not summaries:
+        return "Không có dump nào phù hợp."
+
+    lines = [f"{len(summaries)} dump trong {dump_dir} (total_ms >= {min_total_ms})", ""]
+    stages = {}
+    for summary in summaries:
+        for stage, ms in summary.get("stage_timings", {}).items():
+            stages.setdefault(stage, []).append(ms)
+    lines.append(f"{'stage':<20}{'count':>7}{'mean_ms':>11}{'p95_ms':>11}{'max_ms':>11}")
+    for stage, values in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        lines.append(f"{stage:<20}{len(values):>7}{sum(values) / len(values):>11.2f}"
+                     f"{_percentile(values, 95):>11.2f}{max(values):>11.2f}")
+
+    lines += ["", f"{slowest} lần giải chậm nhất:"]
+    for summary in sorted(summaries, key=lambda s: -s.get("total_ms", 0))[:slowest]:
+        hashes = ", ".join(f"{k}={v[:12]}" for k, v in summary.get("input_hashes", {}).items())
+        lines.append(f"  {summary['profile_id']}  {summary.get('total_ms', 0):.1f} ms  {hashes}")
+
+    prof_files = [os.path.join(dump_dir, s["profile_id"] + ".prof") for s in summaries]
+    prof_files = [p for p in prof_files if os.path.exists(p)]
+    if prof_files:
+        stream = io.StringIO()
+        stats = pstats.Stats(*prof_files, stream=stream)
+        stats.sort_stats(sort).print_stats(top)
+        lines += ["", stream.getvalue()]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_report = sub.add_parser("report", help="Tổng hợp dump thành báo cáo hàm nóng")
+    p_report.add_argument("dump_dir", nargs="?", default="profiles")
+    p_report.add_argument("--top", type=int, default=25)
+    p_report.add_argument("--sort", default="cumulative", help="Khóa sắp xếp pstats (cumulative, tottime, ncalls...)")
+    p_report.add_argument("--min-total-ms", type=float, default=0, help="Chỉ tính các lần giải chậm hơn ngưỡng này")
+    p_report.add_argument("--slowest", type=int, default=5)
+    args = parser.parse_args(argv)
+    print(build_report(args.dump_dir, args.top, args.sort, args.min_total_ms, args.slowest))
+
+
+if __name__ == "__main__":
+    main()
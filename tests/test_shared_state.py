@@ -0,0 +1,101 @@
+"""Chạy cùng một bộ kiểm thử trên cả hai backend trạng thái dùng chung (shared_state)."""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared_state import LocalRedis, RedisStateBackend, SQLiteStateBackend
+
+
+@pytest.fixture(params=["local-redis", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteStateBackend(str(tmp_path / "state.db"))
+    return RedisStateBackend(LocalRedis())
+
+
+def test_pop_expired_returns_rows_in_expiry_order(backend):
+    backend.push_expiry(5, 300.0)
+    backend.push_expiry(3, 100.0)
+    backend.push_expiry(9, 200.0)
+    backend.push_expiry(7, 900.0)
+
+    assert backend.pop_expired(500.0) == [3, 9, 5]
+    assert backend.queue_size() == 1
+    # Dòng đã lấy ra không bị trả lại lần nữa
+    assert backend.pop_expired(500.0) == []
+    assert backend.pop_expired(1000.0) == [7]
+
+
+def test_push_expiry_replaces_existing_row(backend):
+    backend.push_expiry(4, 100.0)
+    backend.push_expiry(4, 800.0)
+
+    assert backend.queue_size() == 1
+    assert backend.pop_expired(500.0) == []
+
+
+def test_remove_row_and_clear_queue(backend):
+    for row in (2, 3, 4):
+        backend.push_expiry(row, 100.0)
+    backend.remove_row(3)
+    assert backend.pop_expired(200.0) == [2, 4]
+
+    backend.push_expiry(6, 100.0)
+    backend.clear_queue()
+    assert backend.queue_size() == 0
+    assert backend.pop_expired(200.0) == []
+
+
+def test_leader_lease_is_exclusive_until_ttl(backend):
+    assert backend.acquire_leader("cleanup", "worker-a", 0.2)
+    assert not backend.acquire_leader("cleanup", "worker-b", 0.2)
+    # Leader hiện tại gia hạn được lease của mình
+    assert backend.acquire_leader("cleanup", "worker-a", 0.2)
+
+
+def test_leader_lease_taken_over_after_ttl(backend):
+    assert backend.acquire_leader("cleanup", "worker-a", 0.2)
+    time.sleep(0.3)
+
+    assert backend.acquire_leader("cleanup", "worker-b", 0.2)
+    assert not backend.acquire_leader("cleanup", "worker-a", 0.2)
+
+
+def test_leases_are_independent_by_name(backend):
+    assert backend.acquire_leader("cleanup", "worker-a", 10)
+    assert backend.acquire_leader("slider-calibration", "worker-b", 10)
+
+
+def test_cache_append_and_pop(backend):
+    backend.set_cache([["t1", "Mới", "a"], ["t2", "Mới", "b"]])
+    assert backend.append_cache(["t3", "Mới", "c"]) == 3
+
+    assert backend.pop_cache(1)
+    assert backend.get_cache() == [["t1", "Mới", "a"], ["t3", "Mới", "c"]]
+    assert backend.cache_size() == 2
+
+
+def test_pop_cache_out_of_range_leaves_cache_unchanged(backend):
+    rows = [["t1", "Mới", "a"], ["t2", "Mới", "b"]]
+    backend.set_cache(rows)
+
+    assert not backend.pop_cache(2)
+    assert not backend.pop_cache(10)
+    assert backend.get_cache() == rows
+
+    backend.set_cache([])
+    assert not backend.pop_cache(0)
+    assert backend.get_cache() == []
+
+
+def test_jobs_expire_after_ttl(backend):
+    backend.put_job("job-1", {"status": "done", "result": {"position": 42}}, 0.2)
+    assert backend.get_job("job-1") == {"status": "done", "result": {"position": 42}}
+    assert backend.get_job("missing") is None
+
+    time.sleep(0.3)
+    assert backend.get_job("job-1") is None